@@ -8,10 +8,169 @@ import glob
 import csv
 import tempfile
 import time
+import hashlib
+import io
+import zlib
+import socket
+import threading
+import argparse
+import uuid
+import math
+import struct
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import re
+
+# Optional dependencies for the in-process (native) engine
+try:
+    import numpy as np
+    from scipy import ndimage
+    from scipy.spatial import ConvexHull
+except ImportError:
+    np = None
+    ndimage = None
+    ConvexHull = None
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+    ImageDraw = None
 
 CONFIG_FILE = os.path.expanduser("~/.nuclei_counter_config.json")
 HISTORY_FILE = os.path.expanduser("~/.nuclei_counter_history.json")
+QC_DIR = os.path.expanduser("~/.nuclei_counter_qc")
+QC_THUMBNAIL_SIZE = 512
+TIMINGS_FILE = os.path.expanduser("~/.nuclei_counter_timings.json")
+PLAN_LOG_FILE = os.path.expanduser("~/.nuclei_counter_plans.jsonl")
+IMAGEJ_TIMEOUT_SECONDS = 300
+PIXEL_CACHE_DIR = os.path.expanduser("~/.nuclei_counter_pixels")
+PIXEL_CACHE_MAX_MB = 2048
+TILE_STATE_DIR = os.path.expanduser("~/.nuclei_counter_tiles")
+TILE_SIZE = 1024
+TILE_HALO = 128
+TILE_FILTER_CACHE_BYTES = 512 * 1024 * 1024
+
+METRIC_DEFINITIONS = {
+    "nuclei_counter_images_processed_total": ("counter", "Images counted successfully."),
+    "nuclei_counter_image_failures_total": ("counter", "Images that could not be counted, by reason."),
+    "nuclei_counter_image_seconds": ("histogram", "Per-image processing time in seconds."),
+    "nuclei_counter_imagej_launches_total": ("counter", "ImageJ processes started."),
+    "nuclei_counter_queue_depth": ("gauge", "Work items waiting in a processing queue."),
+    "nuclei_counter_cache_requests_total": ("counter", "Cache lookups, by cache and result (hit or miss)."),
+    "nuclei_counter_history_writes_total": ("counter", "History file writes, by result."),
+    "nuclei_counter_history_entries": ("gauge", "Entries currently stored in the history file.")
+}
+METRIC_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC_VALUES = {name: {} for name in METRIC_DEFINITIONS}
+METRICS_LOCK = threading.Lock()
+
+def metric_inc(name, value=1, **labels):
+    """Increase a counter metric."""
+    key = tuple(sorted(labels.items()))
+    with METRICS_LOCK:
+        METRIC_VALUES[name][key] = METRIC_VALUES[name].get(key, 0) + value
+
+def metric_set(name, value, **labels):
+    """Set a gauge metric."""
+    with METRICS_LOCK:
+        METRIC_VALUES[name][tuple(sorted(labels.items()))] = value
+
+def metric_observe(name, value, **labels):
+    """Record an observation in a histogram metric."""
+    key = tuple(sorted(labels.items()))
+    with METRICS_LOCK:
+        buckets, total, count = METRIC_VALUES[name].get(key, ([0] * len(METRIC_BUCKETS), 0.0, 0))
+        buckets = [n + (1 if value <= bound else 0) for n, bound in zip(buckets, METRIC_BUCKETS)]
+        METRIC_VALUES[name][key] = (buckets, total + value, count + 1)
+
+def record_image_metrics(engine, seconds=None, reason=None):
+    """Update the per-image metrics for one processed image; reason marks a failure."""
+    if reason:
+        metric_inc("nuclei_counter_image_failures_total", engine=engine, reason=reason)
+        return
+    metric_inc("nuclei_counter_images_processed_total", engine=engine)
+    if seconds is not None:
+        metric_observe("nuclei_counter_image_seconds", seconds, engine=engine)
+
+def format_metric_labels(labels):
+    """Format a sorted label tuple as a Prometheus label set."""
+    if not labels:
+        return ""
+    escaped = [(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in labels]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+def render_metrics():
+    """Render all metrics in the Prometheus text exposition format."""
+    lines = []
+    with METRICS_LOCK:
+        for name, (metric_type, help_text) in METRIC_DEFINITIONS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in sorted(METRIC_VALUES[name].items()):
+                if metric_type != "histogram":
+                    lines.append(f"{name}{format_metric_labels(labels)} {value}")
+                    continue
+                buckets, total, count = value
+                for bound, bucket_count in zip(METRIC_BUCKETS, buckets):
+                    lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', bound),))} {bucket_count}")
+                lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{format_metric_labels(labels)} {total}")
+                lines.append(f"{name}_count{format_metric_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """Serve metrics at http://host:port/metrics from a background thread."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = render_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[INFO] Metrics available at http://{host}:{server.server_port}/metrics")
+    return server
+
+def write_metrics_textfile(path):
+    """Atomically write the current metrics to a textfile-collector file."""
+    try:
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(render_metrics())
+        os.replace(temp_path, path)
+    except Exception as e:
+        print(f"[ERROR] Failed to write metrics file: {e}")
+
+def start_metrics_textfile(path, interval=15):
+    """Periodically write metrics to a file for the node exporter textfile collector."""
+    def write_loop():
+        while True:
+            write_metrics_textfile(path)
+            time.sleep(interval)
+    
+    threading.Thread(target=write_loop, daemon=True).start()
+    print(f"[INFO] Writing metrics to {path} every {interval}s")
+
+def start_metrics_exporters(port=None, textfile=None):
+    """Start whichever metrics exporters were requested on the command line."""
+    if port is not None:
+        start_metrics_server(port)
+    if textfile:
+        start_metrics_textfile(textfile)
 
 def get_history():
     """Load counting history from file."""
@@ -25,35 +184,87 @@ def get_history():
             return []
     return []
 
-def save_to_history(filename, count):
-    """Save a count result to history."""
+def new_qc_run_id():
+    """Return a unique ID for the QC overlays written by one counting run."""
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+def get_qc_path(image_path, run_id):
+    """Return the QC overlay thumbnail path for an image in a counting run.
+
+    Each run writes its own file, so re-counting an image never replaces the
+    overlay an older history entry points to.
+    """
+    key = hashlib.sha1(os.path.abspath(image_path).encode("utf-8")).hexdigest()[:12]
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(QC_DIR, f"{stem}_{key}_{run_id}.png")
+
+def remove_qc_files(removed_entries, remaining_entries):
+    """Delete QC overlays that are no longer referenced by any history entry."""
+    in_use = {entry.get("qc_path") for entry in remaining_entries}
+    for entry in removed_entries:
+        qc_path = entry.get("qc_path")
+        if qc_path and qc_path not in in_use and os.path.exists(qc_path):
+            try:
+                os.unlink(qc_path)
+            except Exception as e:
+                print(f"[DEBUG] Could not remove QC overlay {qc_path}: {e}")
+
+def write_json_atomic(path, data):
+    """Write JSON to a temporary file and rename it over path."""
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(temp_path, path)
+
+def write_history(history):
+    """Atomically replace the history file with the given entries."""
+    write_json_atomic(HISTORY_FILE, history)
+
+def save_entries_to_history(entries):
+    """Append several result entries to history in a single write."""
     try:
         history = get_history()
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        entry = {
-            "filename": filename,
-            "count": count,
-            "timestamp": timestamp
-        }
-        history.append(entry)
+        for entry in entries:
+            entry.setdefault("timestamp", timestamp)
+            history.append(entry)
         # Keep only last 100 entries
         if len(history) > 100:
+            remove_qc_files(history[:-100], history[-100:])
             history = history[-100:]
         
-        with open(HISTORY_FILE, "w") as f:
-            json.dump(history, f, indent=2)
-        print(f"[INFO] Saved to history: {filename} - {count}")
+        write_history(history)
+        metric_inc("nuclei_counter_history_writes_total", result="ok")
+        metric_set("nuclei_counter_history_entries", len(history))
+        for entry in entries:
+            print(f"[INFO] Saved to history: {entry.get('filename')} - {entry.get('count')}")
+        return True
     except Exception as e:
+        metric_inc("nuclei_counter_history_writes_total", result="error")
         print(f"[ERROR] Failed to save to history: {e}")
+        return False
+
+def save_to_history(filename, count, qc_path=None, extra=None):
+    """Save a count result to history. extra holds optional fields such as the ROI area."""
+    entry = {
+        "filename": filename,
+        "count": count
+    }
+    if qc_path:
+        entry["qc_path"] = qc_path
+    if extra:
+        entry.update(extra)
+    save_entries_to_history([entry])
 
 def delete_history_entry(filename, timestamp):
     """Delete a specific entry from history."""
     try:
         history = get_history()
+        removed = [entry for entry in history if entry.get("filename") == filename and entry.get("timestamp") == timestamp]
         history = [entry for entry in history if not (entry.get("filename") == filename and entry.get("timestamp") == timestamp)]
+        remove_qc_files(removed, history)
         
-        with open(HISTORY_FILE, "w") as f:
-            json.dump(history, f, indent=2)
+        write_history(history)
         print(f"[INFO] Deleted from history: {filename} - {timestamp}")
         return True
     except Exception as e:
@@ -63,8 +274,8 @@ def delete_history_entry(filename, timestamp):
 def clear_all_history():
     """Clear all history entries."""
     try:
-        with open(HISTORY_FILE, "w") as f:
-            json.dump([], f, indent=2)
+        remove_qc_files(get_history(), [])
+        write_history([])
         print("[INFO] All history cleared")
         return True
     except Exception as e:
@@ -79,14 +290,22 @@ def get_processing_settings():
                 config = json.load(f)
             return config.get("processing_settings", {
                 "use_watershed": True,
-                "disable_macro": False
+                "disable_macro": False,
+                "channel": 0,
+                "pixel_cache": False,
+                "incremental": False,
+                "native_engine": False
             })
         except:
             pass
     
     return {
         "use_watershed": True,
-        "disable_macro": False
+        "disable_macro": False,
+        "channel": 0,
+        "pixel_cache": False,
+        "incremental": False,
+        "native_engine": False
     }
 
 def save_processing_settings(settings):
@@ -153,6 +372,12 @@ NUCLEI COUNTER - PROTOCOL
 2. PREPARE YOUR IMAGES
    • Supported formats: .jpg, .jpeg
    • Images should show nuclei clearly
+   • Optional region of interest: put <image name>.roi.json next to an
+     image, or roi.json in the folder for all its images, e.g.
+       {"type": "rectangle", "x": 100, "y": 100, "width": 800, "height": 600}
+       {"type": "polygon", "points": [[0, 0], [500, 0], [250, 400]]}
+       {"type": "mask", "path": "well_mask.png"}
+     Add "pixel_size_um": 0.65 to also get nuclei per mm²
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
@@ -161,6 +386,7 @@ PROCESSING OPTIONS
 KEEP IMAGES OPEN
    Checked: ImageJ stays open with processed images for inspection
    Unchecked: ImageJ closes automatically after processing (faster)
+   QC overlays are saved either way, so this is rarely needed
 
 WATERSHED SEGMENTATION
    Enabled: Separates touching nuclei (recommended)
@@ -170,6 +396,11 @@ MACRO PROCESSING
    Enabled: Uses your custom macro file (if selected)
    Disabled: Forces built-in processing (overrides custom macro)
 
+NUCLEAR STAIN CHANNEL
+   All channels: Blends every channel into one 8-bit image
+   1-4: Processes only that channel (e.g. 3 (Blue) for DAPI on RGB images)
+   Other stains then cannot bleed into the nuclei mask
+
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
 PROCESSING WORKFLOW
@@ -181,18 +412,34 @@ PROCESSING WORKFLOW
 
 2. AUTOMATIC PROCESSING
    • ImageJ opens and processes each image
+   • Batch size and number of parallel ImageJ sessions are chosen
+     automatically from the timings of previous runs
+   • With "Allow in-process engine" checked (needs numpy, scipy and
+     Pillow), built-in processing may run without starting ImageJ when
+     that is faster; its counts are not yet validated against ImageJ
+   • Custom macros also run in-process when all their commands are
+     supported; the console lists any command that needs ImageJ
+   • With "Cache decoded pixels" on, in-process runs keep decoded images
+     on disk (up to 2 GB by default) so re-runs skip decoding; it can only
+     be turned on together with the in-process engine or incremental
+     re-counting, as ImageJ runs do not use it
+   • With "Incremental re-counting" on, large images are counted in tiles
+     and a re-count only re-processes the tiles that changed
    • Built-in processing steps:
      - Convert to 8-bit
      - Apply median filter (noise reduction)
      - Auto threshold (Otsu method)
      - Convert to binary mask
      - Invert colors
-     - Watershed segmentation (if enabled)
+     - Watershed segmentation (always, never, or auto: only for
+       images with oversized or irregular particles)
      - Analyze particles (size: 450-25000 pixels)
 
 3. RESULTS
    • Counts appear in the history table
    • Results are automatically saved
+   • A QC overlay (detected nuclei outlined in red) is saved for each image
+   • Double-click a history entry to view its QC overlay
    • ImageJ may stay open for inspection (if option is checked)
 
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
@@ -245,6 +492,30 @@ Built-in processing: 8-bit → Median filter → Otsu threshold → Mask → Wat
         canvas.yview_scroll(int(-1*(event.delta/120)), "units")
     canvas.bind("<MouseWheel>", _on_mousewheel)
 
+def show_qc_overlay(parent, entry):
+    """Open a window showing the saved QC overlay for a history entry."""
+    try:
+        qc_window = tk.Toplevel(parent)
+        qc_window.title(f"QC Overlay - {entry.get('filename', 'Unknown')}")
+        
+        photo = tk.PhotoImage(file=entry["qc_path"])
+        # Keep a reference so the image is not garbage collected
+        qc_window.photo = photo
+        
+        ttk.Label(qc_window, image=photo).pack(padx=10, pady=10)
+        ttk.Label(qc_window, text=f"File: {entry.get('filename', 'Unknown')}    Count: {entry.get('count', 'N/A')}    Timestamp: {entry.get('timestamp', 'Unknown')}").pack(padx=10)
+        if "roi_area_px" in entry:
+            roi_text = f"ROI area: {entry['roi_area_px']} px"
+            if "density_per_mm2" in entry:
+                roi_text += f" ({entry['roi_area_mm2']} mm²)    Density: {entry['density_per_mm2']} nuclei/mm²"
+            ttk.Label(qc_window, text=roi_text).pack(padx=10)
+        if "watershed" in entry:
+            ttk.Label(qc_window, text=f"Watershed: {entry['watershed']}").pack(padx=10)
+        ttk.Button(qc_window, text="Close", command=qc_window.destroy).pack(pady=10)
+    except Exception as e:
+        print(f"[ERROR] Failed to show QC overlay: {e}")
+        messagebox.showerror("Error", f"Could not display QC overlay: {e}")
+
 def create_tooltip(widget, text):
     """Create a tooltip for a widget."""
     def show_tooltip(event):
@@ -327,8 +598,235 @@ def get_config():
         print(f"[ERROR] Failed to get config: {e}")
         sys.exit(1)
 
-def count_multiple_nuclei_with_imagej(image_paths, macro_path, imagej_path, keep_images_open=False, use_watershed=True, disable_macro=False):
-    """Count nuclei in multiple images using a single ImageJ session."""
+def find_roi_definition(image_path):
+    """Find the region of interest for an image.
+
+    Looks for <image name>.roi.json next to the image, then roi.json in the
+    same folder. Supported definitions:
+        {"type": "rectangle", "x": 0, "y": 0, "width": 100, "height": 100}
+        {"type": "polygon", "points": [[x1, y1], [x2, y2], ...]}
+        {"type": "mask", "path": "well_mask.png"}  (non-zero pixels are inside)
+    An optional "pixel_size_um" allows densities per mm² to be computed.
+    """
+    folder = os.path.dirname(os.path.abspath(image_path))
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    for candidate in (os.path.join(folder, f"{stem}.roi.json"), os.path.join(folder, "roi.json")):
+        if not os.path.exists(candidate):
+            continue
+        try:
+            with open(candidate, "r") as f:
+                roi = json.load(f)
+            if roi.get("type") not in ("rectangle", "polygon", "mask"):
+                print(f"[WARNING] Unknown ROI type in {candidate}: {roi.get('type')}")
+                return None
+            if roi["type"] == "mask":
+                roi["path"] = os.path.join(os.path.dirname(candidate), roi["path"])
+            return roi
+        except Exception as e:
+            print(f"[WARNING] Could not read ROI definition {candidate}: {e}")
+            return None
+    return None
+
+def get_polygon_bounds(points):
+    """Return the integer bounding box (x, y, width, height) of a polygon."""
+    xs = [point[0] for point in points]
+    ys = [point[1] for point in points]
+    x0, y0 = max(0, math.floor(min(xs))), max(0, math.floor(min(ys)))
+    return x0, y0, math.ceil(max(xs)) - x0 + 1, math.ceil(max(ys)) - y0 + 1
+
+def get_roi_fields(roi, roi_area, count):
+    """History fields describing the ROI area and, with a known pixel size, the density."""
+    if not roi or not roi_area:
+        return {}
+    fields = {"roi_area_px": roi_area}
+    if roi.get("pixel_size_um"):
+        area_mm2 = roi_area * (roi["pixel_size_um"] ** 2) / 1e6
+        fields["roi_area_mm2"] = round(area_mm2, 6)
+        fields["density_per_mm2"] = round(count / area_mm2, 3)
+    return fields
+
+def get_run_qc_path(image_details):
+    """The QC overlay written for an image in this run, or None if there is none."""
+    qc_path = image_details.get("qc_path")
+    return qc_path if qc_path and os.path.exists(qc_path) else None
+
+def get_result_fields(image_path, image_details, count):
+    """History fields for one counted image: engine, ROI area and density, and the watershed decision."""
+    fields = get_roi_fields(find_roi_definition(image_path), image_details.get("roi_area"), count)
+    if image_details.get("engine"):
+        fields["engine"] = image_details["engine"]
+    if image_details.get("watershed"):
+        fields["watershed"] = image_details["watershed"]
+    return fields
+
+def build_roi_macro(roi):
+    """Build macro snippets for an ROI: crop to its bounds, restrict analysis to it, and clean up.
+
+    The crop snippet sets roi_area (in pixels). The restrict snippet is placed
+    right before Analyze Particles so only objects inside the ROI are counted.
+    """
+    if roi["type"] == "rectangle":
+        crop = f'''// Crop to the region of interest
+        makeRectangle({int(roi["x"])}, {int(roi["y"])}, {int(roi["width"])}, {int(roi["height"])});
+        run("Crop");
+        roi_area = getWidth() * getHeight();'''
+        return crop, "", ""
+    
+    if roi["type"] == "polygon":
+        x0, y0, width, height = get_polygon_bounds(roi["points"])
+        xs = ", ".join(str(point[0] - x0) for point in roi["points"])
+        ys = ", ".join(str(point[1] - y0) for point in roi["points"])
+        crop = f'''// Crop to the region of interest and build its mask
+        roi_work_id = getImageID();
+        makeRectangle({x0}, {y0}, {width}, {height});
+        run("Crop");
+        newImage("roi_mask", "8-bit black", getWidth(), getHeight(), 1);
+        roi_mask_id = getImageID();
+        makeSelection("polygon", newArray({xs}), newArray({ys}));
+        run("Set...", "value=255");
+        setThreshold(1, 255);
+        run("Create Selection");
+        getStatistics(roi_area);
+        run("Select None");
+        selectImage(roi_work_id);'''
+    else:
+        safe_mask_path = roi["path"].replace(chr(92), '/').replace('"', '\\"')
+        crop = f'''// Crop to the region of interest given by a mask image
+        roi_work_id = getImageID();
+        open("{safe_mask_path}");
+        roi_mask_id = getImageID();
+        if (bitDepth() != 8) run("8-bit");
+        setThreshold(1, 255);
+        run("Create Selection");
+        getStatistics(roi_area);
+        getPixelSize(roi_unit, roi_pixel_width, roi_pixel_height);
+        roi_area = roi_area / (roi_pixel_width * roi_pixel_height);
+        getSelectionBounds(roi_x, roi_y, roi_width, roi_height);
+        run("Select None");
+        makeRectangle(roi_x, roi_y, roi_width, roi_height);
+        run("Crop");
+        selectImage(roi_work_id);
+        makeRectangle(roi_x, roi_y, roi_width, roi_height);
+        run("Crop");'''
+    
+    restrict = '''// Only analyze particles inside the region of interest
+roi_work_id = getImageID();
+selectImage(roi_mask_id);
+setThreshold(1, 255);
+run("Create Selection");
+selectImage(roi_work_id);
+run("Restore Selection");
+'''
+    cleanup = '''if (isOpen(roi_mask_id)) {
+            selectImage(roi_mask_id);
+            close();
+        }'''
+    return crop, restrict, cleanup
+
+def build_qc_macro(qc_path):
+    """Build the macro snippet that saves an outline overlay thumbnail for the current image."""
+    safe_qc_path = qc_path.replace(chr(92), '/').replace('"', '\\"')
+    return f'''// Save QC overlay (mask outlines drawn on a thumbnail of the original)
+        if (isOpen(qc_mask_id) && isOpen(qc_source_id)) {{
+            selectImage(qc_mask_id);
+            run("Select None");
+            if (is("binary")) {{
+                run("Create Selection");
+                qc_has_selection = selectionType() != -1;
+                selectImage(qc_source_id);
+                if (bitDepth() != 24) run("RGB Color");
+                qc_scale = minOf(1, {QC_THUMBNAIL_SIZE} / maxOf(getWidth(), getHeight()));
+                if (qc_has_selection) {{
+                    run("Restore Selection");
+                    setForegroundColor(255, 0, 0);
+                    setLineWidth(maxOf(1, round(1 / qc_scale)));
+                    run("Draw", "slice");
+                    run("Select None");
+                }}
+                run("Size...", "width=" + round(getWidth() * qc_scale) + " height=" + round(getHeight() * qc_scale) + " interpolation=Bilinear");
+                saveAs("PNG", "{safe_qc_path}");
+            }}
+            selectImage(qc_source_id);
+            close();
+        }}'''
+
+def build_watershed_macro(use_watershed):
+    """Build the built-in macro's watershed step for use_watershed True, False or WATERSHED_AUTO.
+
+    Every variant sets watershed_decision, which is written next to the count.
+    In auto mode a particle pre-pass (area against the median particle area,
+    and solidity) decides whether the image needs watershed at all. The
+    pre-pass measures each outline with List.setMeasurements, so the user's
+    Set Measurements choices and the Results table are left untouched.
+    """
+    if use_watershed == WATERSHED_AUTO:
+        return f'''// Auto watershed: split only when some particle looks like touching nuclei
+run("Analyze Particles...", "size={BUILTIN_MIN_NUCLEUS_SIZE}-Infinity show=Overlay");
+watershed_objects = Overlay.size;
+watershed_candidates = 0;
+if (watershed_objects > 0) {{
+    watershed_areas = newArray(watershed_objects);
+    watershed_solidities = newArray(watershed_objects);
+    for (watershed_i = 0; watershed_i < watershed_objects; watershed_i++) {{
+        Overlay.activateSelection(watershed_i);
+        List.setMeasurements;
+        watershed_areas[watershed_i] = List.getValue("Area");
+        watershed_solidities[watershed_i] = List.getValue("Solidity");
+    }}
+    watershed_sorted = Array.copy(watershed_areas);
+    Array.sort(watershed_sorted);
+    watershed_typical = watershed_sorted[floor(watershed_objects / 2)];
+    for (watershed_i = 0; watershed_i < watershed_objects; watershed_i++) {{
+        if (watershed_areas[watershed_i] > {CLUMP_AREA_RATIO} * watershed_typical || watershed_solidities[watershed_i] < {CLUMP_MIN_SOLIDITY}) watershed_candidates++;
+    }}
+    List.clear();
+}}
+Overlay.remove;
+run("Select None");
+if (watershed_candidates > 0) run("Watershed");
+watershed_decision = "auto:" + watershed_candidates + "/" + watershed_objects;'''
+    if use_watershed:
+        return '''run("Watershed");
+watershed_decision = "on";'''
+    return '''// Watershed disabled
+watershed_decision = "off";'''
+
+def build_channel_macro(channel):
+    """Build the macro snippet that reduces the open image to one (1-based) channel."""
+    return f'''// Keep only the nuclear-stain channel ({channel})
+        channel_source_id = getImageID();
+        channel_done = false;
+        if (nSlices > 1) {{
+            getDimensions(channel_width, channel_height, channel_count, channel_slices, channel_frames);
+            if (channel_count > 1) Stack.setChannel(minOf({channel}, channel_count));
+            else setSlice(minOf({channel}, nSlices));
+            channel_done = true;
+        }}
+        run("Duplicate...", "title=nuclear_channel");
+        channel_id = getImageID();
+        selectImage(channel_source_id);
+        close();
+        selectImage(channel_id);
+        if (!channel_done && bitDepth() == 24) {{
+            run("RGB Stack");
+            setSlice({min(channel, 3)});
+            run("Duplicate...", "title=nuclear_channel_plane");
+            channel_plane_id = getImageID();
+            selectImage(channel_id);
+            close();
+            selectImage(channel_plane_id);
+        }}'''
+
+def count_multiple_nuclei_with_imagej(image_paths, macro_path, imagej_path, keep_images_open=False, use_watershed=True, disable_macro=False, save_qc=True, details=None, allow_multiple=False, channel=0):
+    """Count nuclei in multiple images using a single ImageJ session.
+
+    When save_qc is enabled, an outline overlay thumbnail is written for each
+    image so results can be inspected later without keeping ImageJ open. If
+    details is a dict it is filled with the per-image dimensions, processing
+    time and the overlay written in this run (qc_path). Set allow_multiple when several
+    sessions run side by side. With channel > 0 only that (1-based) channel is
+    processed instead of blending all channels with run("8-bit").
+    """
     print(f"[STEP] Running ImageJ once for {len(image_paths)} images")
     
     if not image_paths:
@@ -339,6 +837,15 @@ def count_multiple_nuclei_with_imagej(image_paths, macro_path, imagej_path, keep
         print(f"[ERROR] ImageJ executable not found: {imagej_path}")
         return {}
     
+    if save_qc:
+        try:
+            os.makedirs(QC_DIR, exist_ok=True)
+        except Exception as e:
+            print(f"[WARNING] Could not create QC directory, overlays disabled: {e}")
+            save_qc = False
+    qc_run_id = new_qc_run_id()
+    qc_paths = {}
+    
     temp_results = tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.csv')
     temp_results_path = temp_results.name
     temp_results.close()
@@ -356,27 +863,27 @@ def count_multiple_nuclei_with_imagej(image_paths, macro_path, imagej_path, keep
         except Exception as e:
             print(f"[WARNING] Could not read custom macro: {e}")
             print("[INFO] Using built-in processing steps")
-            watershed_step = 'run("Watershed");' if use_watershed else '// Watershed disabled'
+            watershed_step = build_watershed_macro(use_watershed)
             processing_steps = f'''run("8-bit");
 run("Median...", "radius=3");
 setAutoThreshold("Otsu");
 run("Convert to Mask");
 run("Invert");
 {watershed_step}
-run("Analyze Particles...", "size=450-25000 circularity=0.00-1.00 show=Nothing clear");'''
+run("Analyze Particles...", "size={BUILTIN_MIN_NUCLEUS_SIZE}-25000 circularity=0.00-1.00 show=Nothing clear");'''
     else:
         print("[INFO] Using built-in processing steps")
         if disable_macro:
             print("[INFO] Custom macro disabled by user setting")
         
-        watershed_step = 'run("Watershed");' if use_watershed else '// Watershed disabled'
+        watershed_step = build_watershed_macro(use_watershed)
         processing_steps = f'''run("8-bit");
 run("Median...", "radius=3");
 setAutoThreshold("Otsu");
 run("Convert to Mask");
 run("Invert");
 {watershed_step}
-run("Analyze Particles...", "size=450-25000 circularity=0.00-1.00 show=Nothing clear");'''
+run("Analyze Particles...", "size={BUILTIN_MIN_NUCLEUS_SIZE}-25000 circularity=0.00-1.00 show=Nothing clear");'''
     
     batch_mode = "true" if not keep_images_open else "false"
     close_images = "run(\"Close All\");" if not keep_images_open else "// Images kept open for inspection"
@@ -390,7 +897,7 @@ setBatchMode({batch_mode});
 results_path = "{temp_results_path.replace(chr(92), '/')}";
 
 // Write CSV header
-File.append("Filename,Count", results_path);
+File.append("Filename,Count,Width,Height,Millis,RoiArea,Watershed", results_path);
 
 print("Starting batch processing of {len(image_paths)} images...");
 
@@ -400,30 +907,70 @@ print("Starting batch processing of {len(image_paths)} images...");
         safe_image_path = image_path.replace(chr(92), '/').replace('"', '\\"')
         filename = os.path.basename(image_path)
         
+        if channel and image_path.lower().endswith((".tif", ".tiff")):
+            # A virtual stack only reads the pages that are accessed
+            open_step = f'run("TIFF Virtual Stack...", "open=[{safe_image_path}]");'
+        else:
+            open_step = f'open("{safe_image_path}");'
+        channel_step = build_channel_macro(channel) if channel else "// All channels used"
+        
+        roi = find_roi_definition(image_path)
+        if roi:
+            roi_crop, roi_restrict, roi_cleanup = build_roi_macro(roi)
+            # The last Analyze Particles is the one that is counted
+            before, analyze, after = processing_steps.rpartition('run("Analyze Particles...')
+            image_steps = before + roi_restrict + analyze + after if analyze else processing_steps
+        else:
+            roi_crop, roi_cleanup = "// No region of interest", ""
+            image_steps = processing_steps
+        
+        if save_qc:
+            qc_capture = '''qc_mask_id = getImageID();
+        run("Duplicate...", "title=qc_source");
+        qc_source_id = getImageID();
+        selectImage(qc_mask_id);'''
+            qc_paths[filename] = get_qc_path(image_path, qc_run_id)
+            qc_save = build_qc_macro(qc_paths[filename])
+        else:
+            qc_capture = "// QC overlay disabled"
+            qc_save = ""
+        
         batch_macro_content += f'''
 // Process image {i+1}: {filename}
 print("Processing {filename}...");
 run("Clear Results");
+image_start = getTime();
 
 // Enhanced image opening with error handling
 if (File.exists("{safe_image_path}")) {{
-    open("{safe_image_path}");
+    {open_step}
     
     if (nImages > 0) {{
+        {channel_step}
+        image_width = getWidth();
+        image_height = getHeight();
+        roi_area = image_width * image_height;
+        watershed_decision = "custom";
+        {roi_crop}
+        {qc_capture}
+        
         // Processing steps
-        {processing_steps}
+        {image_steps}
         
         count = nResults;
         print("Found " + count + " nuclei in {filename}");
-        File.append("{filename}," + count, results_path);
+        File.append("{filename}," + count + "," + image_width + "," + image_height + "," + (getTime() - image_start) + "," + roi_area + "," + watershed_decision, results_path);
+        
+        {qc_save}
+        {roi_cleanup}
         
     }} else {{
         print("ERROR: Could not open image: {filename}");
-        File.append("{filename},ERROR", results_path);
+        File.append("{filename},ERROR:open_failed,0,0," + (getTime() - image_start) + ",0,", results_path);
     }}
 }} else {{
     print("ERROR: File not found: {safe_image_path}");
-    File.append("{filename},ERROR", results_path);
+    File.append("{filename},ERROR:not_found,0,0," + (getTime() - image_start) + ",0,", results_path);
 }}
 
 {close_images}
@@ -442,17 +989,24 @@ print("Batch processing complete! {completion_message}");
     temp_macro_path = temp_macro.name
     
     cmd = [imagej_path, "-macro", temp_macro_path]
+    if allow_multiple:
+        # Start a separate instance instead of handing the macro to a running one
+        cmd.insert(1, "--allow-multiple")
     
     try:
         print(f"[INFO] Starting ImageJ batch processing...")
         print(f"[INFO] Keep images open: {keep_images_open}")
         print(f"[INFO] Use watershed: {use_watershed}")
         print(f"[INFO] Disable macro: {disable_macro}")
+        print(f"[INFO] Channel: {channel if channel else 'all'}")
         print(f"[INFO] Command: {' '.join(cmd)}")
         
         env = os.environ.copy()
         env['JAVA_OPTS'] = '-Djava.awt.headless=false'
         
+        session_start = time.time()
+        timed_out = False
+        metric_inc("nuclei_counter_imagej_launches_total")
         process = subprocess.Popen(
             cmd, 
             stdout=subprocess.PIPE,
@@ -462,10 +1016,11 @@ print("Batch processing complete! {completion_message}");
         )
         
         try:
-            stdout, stderr = process.communicate(timeout=300)
+            stdout, stderr = process.communicate(timeout=IMAGEJ_TIMEOUT_SECONDS)
             return_code = process.returncode
         except subprocess.TimeoutExpired:
-            print(f"[WARNING] ImageJ batch processing timed out after 5 minutes")
+            print(f"[WARNING] ImageJ batch processing timed out after {IMAGEJ_TIMEOUT_SECONDS // 60} minutes")
+            timed_out = True
             process.kill()
             stdout, stderr = process.communicate()
             return_code = process.returncode
@@ -489,26 +1044,47 @@ print("Batch processing complete! {completion_message}");
                 print(f"[DEBUG] Results file content: {lines}")
                 
                 # Parse CSV results (skip header)
+                image_timings = []
                 for line in lines[1:]:
-                    if ',' in line:
-                        filename, count_str = line.strip().split(',', 1)
-                        if count_str == "ERROR":
+                    if line.count(',') >= 6:
+                        filename, count_str, width, height, millis, roi_area, watershed = line.strip().rsplit(',', 6)
+                        image_seconds = None
+                        try:
+                            timing = {"filename": filename, "width": int(width), "height": int(height), "millis": float(millis), "roi_area": int(float(roi_area))}
+                            image_seconds = timing["millis"] / 1000
+                            image_timings.append(timing)
+                            if details is not None:
+                                qc_path = qc_paths.get(filename)
+                                details[filename] = dict(timing, engine="imagej", watershed=watershed or None,
+                                                         qc_path=qc_path if qc_path and os.path.exists(qc_path) else None)
+                        except ValueError:
+                            print(f"[WARNING] Could not parse timing for {filename}")
+                        if count_str.startswith("ERROR"):
                             results[filename] = None
+                            record_image_metrics("imagej", reason=count_str.partition(":")[2] or "imagej_error")
                             print(f"[ERROR] Processing failed for: {filename}")
                         else:
                             try:
                                 count = int(count_str)
                                 results[filename] = count
+                                record_image_metrics("imagej", image_seconds)
                                 print(f"[SUCCESS] {filename}: {count}")
                             except ValueError:
                                 print(f"[WARNING] Could not parse count for {filename}: {count_str}")
+                                record_image_metrics("imagej", reason="parse_error")
                                 results[filename] = None
+                
+                record_session_timings("imagej", image_timings, time.time() - session_start, {"use_watershed": use_watershed, "disable_macro": disable_macro, "channel": channel})
             else:
                 print(f"[WARNING] Results file not found: {temp_results_path}")
                 
         except Exception as e:
             print(f"[ERROR] Error reading results file: {e}")
         
+        for image_path in image_paths:
+            if os.path.basename(image_path) not in results:
+                record_image_metrics("imagej", reason="timeout" if timed_out else "missing_result")
+        
         return results
         
     finally:
@@ -521,7 +1097,1366 @@ print("Batch processing complete! {completion_message}");
         except Exception as e:
             print(f"[DEBUG] Error cleaning up temp files: {e}")
 
-def select_and_count(keep_images_open=False, use_watershed=True, disable_macro=False):
+def count_multiple_nuclei_stub(image_paths, details=None):
+    """Deterministic stand-in engine for exercising batch plumbing without ImageJ."""
+    results = {}
+    for image_path in image_paths:
+        filename = os.path.basename(image_path)
+        if details is not None:
+            details[filename] = {"engine": "stub"}
+        try:
+            with open(image_path, "rb") as f:
+                results[filename] = zlib.crc32(f.read()) % 1000
+            record_image_metrics("stub")
+        except Exception as e:
+            print(f"[ERROR] Stub engine could not read {filename}: {e}")
+            record_image_metrics("stub", reason="read_failed")
+            results[filename] = None
+    return results
+
+def native_engine_available():
+    """Check whether the optional numpy, scipy and Pillow packages are installed."""
+    return np is not None and ndimage is not None and Image is not None
+
+def convert_plane_to_8bit(plane):
+    """Scale a 16/32-bit plane to 0-255 from its min-max range, as ImageJ does."""
+    if plane.dtype == np.uint8:
+        return plane
+    low, high = float(plane.min()), float(plane.max())
+    scale = 255.0 / (high - low) if high > low else 0.0
+    return ((plane.astype(np.float64) - low) * scale).round().astype(np.uint8)
+
+def read_tiff_channel_plane(image_path, channel):
+    """Read one channel of an uncompressed TIFF without decoding the other channels.
+
+    Handles planar images (PlanarConfiguration=2), where each channel has its
+    own strips, and multi-page files with one channel per page. Returns None
+    when the layout needs a full decode.
+    """
+    with open(image_path, "rb") as f:
+        head = f.read(8)
+        if head[:4] not in (b"II*\x00", b"MM\x00*"):
+            return None
+        byte_order = "<" if head[:2] == b"II" else ">"
+        tags, next_offset = read_tiff_ifd(f, byte_order, struct.unpack(byte_order + "I", head[4:8])[0])
+        
+        samples = tags.get(277, [1])[0]
+        if samples > 1:
+            if tags.get(284, [1])[0] != 2 or channel > samples:
+                return None
+            # ImageJ opens RGB(A) as a 3-channel colour image, so alpha is never picked
+            sample = min(channel, 3) - 1 if tags.get(262, [1])[0] == 2 else channel - 1
+        else:
+            # One channel per page: follow the IFD chain to the requested page
+            for _ in range(channel - 1):
+                if not next_offset:
+                    return None
+                tags, next_offset = read_tiff_ifd(f, byte_order, next_offset)
+            sample = 0
+        
+        bits = tags.get(258, [8])[0]
+        if tags.get(259, [1])[0] != 1 or 273 not in tags or bits not in (8, 16) or tags.get(339, [1])[0] != 1:
+            return None
+        width, height = tags[256][0], tags[257][0]
+        strips_per_plane = math.ceil(height / tags.get(278, [height])[0])
+        first = sample * strips_per_plane
+        data = bytearray()
+        for offset, length in zip(tags[273][first:first + strips_per_plane], tags[279][first:first + strips_per_plane]):
+            f.seek(offset)
+            data += f.read(length)
+    
+    dtype = np.dtype(byte_order + ("u1" if bits == 8 else "u2"))
+    return np.frombuffer(bytes(data), dtype=dtype, count=width * height).reshape(height, width)
+
+def decode_image_plane(image_path, channel=0):
+    """Decode an image into a 2D uint8 array, converting like ImageJ's run("8-bit").
+
+    With channel > 0 only that (1-based) channel is kept instead of blending
+    all of them. Uncompressed planar and multi-page TIFFs are read without
+    decoding the other channels at all.
+    """
+    if channel and isinstance(image_path, str) and image_path.lower().endswith((".tif", ".tiff")):
+        plane = read_tiff_channel_plane(image_path, channel)
+        if plane is not None:
+            return convert_plane_to_8bit(plane)
+    
+    with Image.open(image_path) as img:
+        if channel and getattr(img, "n_frames", 1) > 1:
+            # Pillow decodes pages lazily, so only this page is read
+            img.seek(min(channel, img.n_frames) - 1)
+        if img.mode in ("P", "PA", "CMYK", "YCbCr"):
+            img = img.convert("RGB")
+        if channel and img.mode in ("RGBA", "RGBa", "LA", "La"):
+            # ImageJ drops the alpha band when opening, so channel 4 clamps to blue like setSlice(3)
+            img = img.convert("RGB" if img.mode.startswith("RGB") else "L")
+        if channel and len(img.getbands()) > 1:
+            return convert_plane_to_8bit(np.asarray(img.getchannel(min(channel, len(img.getbands())) - 1)))
+        if img.mode in ("RGB", "RGBA"):
+            # ImageJ converts RGB to 8-bit with unweighted (r+g+b)/3
+            rgb = np.asarray(img.convert("RGB"), dtype=np.uint16)
+            return (rgb.sum(axis=2) // 3).astype(np.uint8)
+        plane = np.asarray(img)
+    if plane.ndim == 3:
+        plane = plane[..., 0]
+    return convert_plane_to_8bit(plane)
+
+WATERSHED_AUTO = "auto"
+CLUMP_AREA_RATIO = 1.5
+CLUMP_MIN_SOLIDITY = 0.93
+BUILTIN_MIN_NUCLEUS_SIZE = 450
+
+def get_builtin_native_steps(use_watershed=True):
+    """Return the built-in processing steps as native (command, options) pairs.
+
+    use_watershed is True, False or WATERSHED_AUTO.
+    """
+    steps = [
+        ("8-bit", {}),
+        ("Median...", {"radius": 3}),
+        ("setAutoThreshold", {"method": "Otsu", "dark": False}),
+        ("Convert to Mask", {}),
+        ("Invert", {})
+    ]
+    if use_watershed == WATERSHED_AUTO:
+        steps.append(("Watershed", {"mode": WATERSHED_AUTO, "min_size": BUILTIN_MIN_NUCLEUS_SIZE}))
+    elif use_watershed:
+        steps.append(("Watershed", {}))
+    steps.append(("Analyze Particles...", {"size": (BUILTIN_MIN_NUCLEUS_SIZE, 25000), "circularity": (0.0, 1.0)}))
+    return steps
+
+def otsu_threshold(plane, histogram=None):
+    """Return the Otsu threshold level of a uint8 image (pixels <= level form the lower class)."""
+    if histogram is None:
+        histogram = np.bincount(plane.ravel(), minlength=256)
+    histogram = np.asarray(histogram, dtype=np.float64)
+    levels = np.arange(256)
+    weight_low = np.cumsum(histogram)
+    weight_high = weight_low[-1] - weight_low
+    sum_low = np.cumsum(histogram * levels)
+    mean_low = sum_low / np.maximum(weight_low, 1)
+    mean_high = (sum_low[-1] - sum_low) / np.maximum(weight_high, 1)
+    between = weight_low * weight_high * (mean_low - mean_high) ** 2
+    return int(np.argmax(between))
+
+def default_threshold(plane, histogram=None):
+    """Return the level of ImageJ's "Default" method (iterative IsoData variant)."""
+    if histogram is None:
+        histogram = np.bincount(plane.ravel(), minlength=256)
+    histogram = np.array(histogram, dtype=np.float64)
+    # Like ImageJ, ignore the extreme bins so erased areas do not count
+    histogram[0] = histogram[255] = 0
+    nonzero = np.nonzero(histogram)[0]
+    if len(nonzero) == 0 or nonzero[0] >= nonzero[-1]:
+        return 128
+    low, high = int(nonzero[0]), int(nonzero[-1])
+    levels = np.arange(256, dtype=np.float64)
+    moving = low
+    while True:
+        below = histogram[low:moving + 1]
+        above = histogram[moving + 1:high + 1]
+        mean_below = (levels[low:moving + 1] * below).sum() / max(below.sum(), 1)
+        mean_above = (levels[moving + 1:high + 1] * above).sum() / max(above.sum(), 1)
+        result = (mean_below + mean_above) / 2
+        moving += 1
+        if not (moving + 1 <= result and moving < high - 1):
+            return int(round(result))
+
+def auto_threshold_range(image, options, histogram=None):
+    """Return the (lower, upper) range a setAutoThreshold step selects."""
+    if options.get("method", "Default") == "Otsu":
+        level = otsu_threshold(image, histogram)
+    else:
+        level = default_threshold(image, histogram)
+    return (level + 1, 255) if options.get("dark") else (0, level)
+
+def disk_footprint(radius):
+    """Circular kernel matching ImageJ's rank filters (r*r + 1 rule)."""
+    r = int(math.ceil(radius))
+    y, x = np.ogrid[-r:r + 1, -r:r + 1]
+    return x * x + y * y <= radius * radius + 1
+
+def watershed_lines(component, distance, markers, marker_count):
+    """Flood one object's EDM from its peaks and return the pixels separating the basins."""
+    labels = markers.copy()
+    footprint = np.ones((3, 3), dtype=bool)
+    # Flood from the EDM peaks downwards one half-pixel level at a time
+    for level in np.arange(math.floor(distance.max()), 0, -0.5):
+        region = component & (distance >= level)
+        while True:
+            grown = ndimage.grey_dilation(labels, footprint=footprint)
+            frontier = region & (labels == 0) & (grown > 0)
+            if not frontier.any():
+                break
+            labels[frontier] = grown[frontier]
+    
+    # Drop pixels touching a lower label so no two basins stay 8-connected
+    lowest_neighbour = ndimage.grey_erosion(np.where(labels > 0, labels, marker_count + 1), footprint=footprint)
+    return (labels > 0) & (lowest_neighbour < labels)
+
+def watershed_mask(mask, components=None):
+    """Split touching objects in a binary mask along EDM watershed lines, like ImageJ's Watershed.
+
+    Only objects with more than one EDM peak are flooded. Pass a subset of
+    component indices to restrict splitting to those objects.
+    """
+    structure = np.ones((3, 3))
+    objects, _ = ndimage.label(mask, structure=structure)
+    
+    result = mask.copy()
+    for index, bbox in enumerate(ndimage.find_objects(objects), start=1):
+        if bbox is None or (components is not None and index not in components):
+            continue
+        component = objects[bbox] == index
+        # Distance map of this object alone, padded so its border counts as background
+        distance = ndimage.distance_transform_edt(np.pad(component, 1))[1:-1, 1:-1]
+        peaks = (distance == ndimage.maximum_filter(distance, size=5)) & (distance > 1)
+        markers, marker_count = ndimage.label(peaks & component, structure=structure)
+        if marker_count < 2:
+            continue
+        result[bbox] &= ~watershed_lines(component, distance, markers, marker_count)
+    return result
+
+def find_clumped_components(mask, min_size=0, area_ratio=CLUMP_AREA_RATIO, min_solidity=CLUMP_MIN_SOLIDITY):
+    """Cheap pre-pass deciding which objects in a binary mask may be touching nuclei.
+
+    The median area of objects of at least min_size pixels is taken as the
+    single-nucleus size. Objects larger than area_ratio times that, or whose
+    solidity (area / convex hull area) is below min_solidity, are candidates
+    for watershed. Returns (set of candidate component indices, number of
+    objects considered); indices match ndimage.label with 8-connectivity.
+    """
+    objects, object_count = ndimage.label(mask, structure=np.ones((3, 3)))
+    if object_count == 0:
+        return set(), 0
+    areas = np.bincount(objects.ravel(), minlength=object_count + 1)
+    considered = [index for index in range(1, object_count + 1) if areas[index] >= min_size]
+    if not considered:
+        return set(), 0
+    typical_area = float(np.median(areas[considered]))
+    
+    candidates = set()
+    corners = np.array([(0, 0), (0, 1), (1, 0), (1, 1)])
+    bboxes = ndimage.find_objects(objects)
+    for index in considered:
+        if areas[index] > area_ratio * typical_area:
+            candidates.add(index)
+            continue
+        component = objects[bboxes[index - 1]] == index
+        edge = np.argwhere(component & ~ndimage.binary_erosion(component))
+        # Hull of the outer pixel corners is never degenerate
+        hull_area = ConvexHull((edge[:, None, :] + corners).reshape(-1, 2)).volume
+        if areas[index] / hull_area < min_solidity:
+            candidates.add(index)
+    return candidates, len(considered)
+
+def analyze_particles(mask, size=(0, float("inf")), circularity=(0.0, 1.0), exclude=False, include=False):
+    """Label 8-connected particles and return the label image and the labels passing the filters.
+
+    exclude drops particles touching the image edge and include fills interior
+    holes, matching the Analyze Particles options of the same names.
+    """
+    if include:
+        mask = ndimage.binary_fill_holes(mask)
+    labels, label_count = ndimage.label(mask, structure=np.ones((3, 3)))
+    if label_count == 0:
+        return labels, []
+    areas = np.bincount(labels.ravel(), minlength=label_count + 1)
+    keep = (areas >= size[0]) & (areas <= size[1])
+    if exclude:
+        keep[np.unique(np.concatenate((labels[0], labels[-1], labels[:, 0], labels[:, -1])))] = False
+    
+    if circularity != (0.0, 1.0):
+        # Perimeter from exposed pixel edges, scaled so a digital disk scores close to 1
+        padded = np.pad(labels, 1)
+        edges = np.zeros(label_count + 1)
+        for shifted in (padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2], padded[1:-1, 2:]):
+            exposed = labels[(labels != shifted) & (labels > 0)]
+            edges += np.bincount(exposed, minlength=label_count + 1)
+        perimeter = np.maximum(edges * math.pi / 4, 1)
+        circ = np.minimum(4 * math.pi * areas / perimeter ** 2, 1.0)
+        keep &= (circ >= circularity[0]) & (circ <= circularity[1])
+    
+    keep[0] = False
+    return labels, list(np.nonzero(keep)[0])
+
+def apply_native_filter(image, command, options):
+    """Apply a step that works on grey values: Median..., Gaussian Blur... or Invert."""
+    if command == "Median...":
+        return ndimage.median_filter(image, footprint=disk_footprint(options.get("radius", 2)))
+    if command == "Gaussian Blur...":
+        return ndimage.gaussian_filter(image.astype(np.float64), options.get("sigma", 2)).round().astype(np.uint8)
+    if command == "Invert":
+        return 255 - image
+    return image
+
+def run_native_pipeline(plane, steps, roi_mask=None, report=None):
+    """Run native processing steps on a uint8 plane. Returns (count, mask of counted objects).
+
+    If roi_mask is given, only the part of each object inside it is analyzed,
+    as with an area selection in ImageJ. If report is a dict, report["watershed"]
+    is set to "on", "off" or "auto:<split candidates>/<objects>".
+    """
+    if report is not None:
+        report["watershed"] = "off"
+    image = plane
+    mask = None
+    threshold = None
+    counted = None
+    
+    for command, options in steps:
+        if command == "8-bit":
+            continue
+        elif command in ("Median...", "Gaussian Blur..."):
+            source = image if mask is None else mask.astype(np.uint8) * 255
+            image = apply_native_filter(source, command, options)
+            mask = None
+        elif command == "setAutoThreshold":
+            threshold = auto_threshold_range(image, options)
+        elif command == "setThreshold":
+            threshold = (options["lower"], options["upper"])
+        elif command == "Convert to Mask":
+            if mask is None:
+                if threshold is None:
+                    threshold = auto_threshold_range(image, options)
+                mask = (image >= threshold[0]) & (image <= threshold[1])
+        elif command == "Invert":
+            if mask is not None:
+                mask = ~mask
+            else:
+                image = apply_native_filter(image, command, options)
+        elif command == "Watershed":
+            if mask is not None and options.get("mode") == WATERSHED_AUTO:
+                candidates, considered = find_clumped_components(mask, options.get("min_size", 0))
+                if candidates:
+                    mask = watershed_mask(mask, candidates)
+                if report is not None:
+                    report["watershed"] = f"auto:{len(candidates)}/{considered}"
+            elif mask is not None:
+                mask = watershed_mask(mask)
+                if report is not None:
+                    report["watershed"] = "on"
+        elif command == "Fill Holes":
+            if mask is not None:
+                mask = ndimage.binary_fill_holes(mask)
+        elif command == "Analyze Particles...":
+            if mask is None:
+                mask = image > 0
+            if roi_mask is not None:
+                mask = mask & roi_mask
+            labels, kept = analyze_particles(mask, options.get("size", (0, float("inf"))), options.get("circularity", (0.0, 1.0)),
+                                             options.get("exclude", False), options.get("include", False))
+            counted = np.isin(labels, kept)
+            return len(kept), counted
+    
+    return 0, counted
+
+def save_native_qc(plane, counted_mask, qc_path):
+    """Save an outline overlay thumbnail for a natively processed image."""
+    if Image is None or counted_mask is None:
+        return
+    outlines = counted_mask & ~ndimage.binary_erosion(counted_mask)
+    rgb = np.repeat(plane[..., None], 3, axis=2)
+    rgb[outlines] = (255, 0, 0)
+    thumbnail = Image.fromarray(rgb)
+    thumbnail.thumbnail((QC_THUMBNAIL_SIZE, QC_THUMBNAIL_SIZE))
+    thumbnail.save(qc_path)
+
+def build_native_roi(roi, shape):
+    """Return (crop slices, inside mask or None, area in pixels) of an ROI on an image of the given shape."""
+    height, width = shape
+    if roi["type"] == "rectangle":
+        x0, y0 = max(0, int(roi["x"])), max(0, int(roi["y"]))
+        x1, y1 = min(width, int(roi["x"] + roi["width"])), min(height, int(roi["y"] + roi["height"]))
+        return (slice(y0, y1), slice(x0, x1)), None, max(0, x1 - x0) * max(0, y1 - y0)
+    
+    if roi["type"] == "polygon":
+        x0, y0, roi_width, roi_height = get_polygon_bounds(roi["points"])
+        x1, y1 = min(width, x0 + roi_width), min(height, y0 + roi_height)
+        canvas = Image.new("L", (roi_width, roi_height), 0)
+        ImageDraw.Draw(canvas).polygon([(x - x0, y - y0) for x, y in roi["points"]], fill=255)
+        inside = np.asarray(canvas)[:y1 - y0, :x1 - x0] > 0
+    else:
+        with Image.open(roi["path"]) as mask_image:
+            full = np.asarray(mask_image.convert("L"))[:height, :width] > 0
+        rows, cols = np.nonzero(full)
+        if len(rows) == 0:
+            return (slice(0, 0), slice(0, 0)), full[:0, :0], 0
+        y0, y1, x0, x1 = rows.min(), rows.max() + 1, cols.min(), cols.max() + 1
+        inside = full[y0:y1, x0:x1]
+    return (slice(y0, y0 + inside.shape[0]), slice(x0, x0 + inside.shape[1])), inside, int(inside.sum())
+
+def count_native_plane(plane, steps, image_path=None, qc_run_id=None, report=None, tiles=None):
+    """Count nuclei in a decoded plane and optionally write its QC overlay.
+
+    Processing is cropped to the image's ROI (see find_roi_definition) if it
+    has one. Returns (count, ROI area in pixels); report is passed on to
+    run_native_pipeline. With a qc_run_id the overlay is saved and its path
+    stored in report["qc_path"]. With tiles (see get_tile_options) the image
+    is counted incrementally and no QC overlay is written.
+    """
+    if tiles and image_path:
+        result = count_native_plane_incremental(plane, steps, image_path, tiles, report)
+        if result is not None:
+            return result
+        print(f"[INFO] Processing steps cannot be split into tiles; counting {os.path.basename(image_path)} whole")
+    
+    roi = find_roi_definition(image_path) if image_path else None
+    roi_mask = None
+    roi_area = plane.shape[0] * plane.shape[1]
+    if roi:
+        bounds, roi_mask, roi_area = build_native_roi(roi, plane.shape)
+        plane = plane[bounds]
+    
+    count, counted = run_native_pipeline(plane, steps, roi_mask, report)
+    if qc_run_id and image_path:
+        qc_path = get_qc_path(image_path, qc_run_id)
+        try:
+            save_native_qc(plane, counted, qc_path)
+            if report is not None and os.path.exists(qc_path):
+                report["qc_path"] = qc_path
+        except Exception as e:
+            print(f"[WARNING] Could not save QC overlay for {os.path.basename(image_path)}: {e}")
+    return count, roi_area
+
+TILE_PREFIX_COMMANDS = ("8-bit", "Median...", "Gaussian Blur...", "Invert")
+TILE_MASK_COMMANDS = ("8-bit", "setThreshold", "Convert to Mask", "Invert", "Watershed", "Fill Holes", "Analyze Particles...")
+
+def get_tile_options(settings, config=None):
+    """Incremental tiled counting options for the native engine, or None if it is off."""
+    if not settings.get("incremental", False):
+        return None
+    config = config or {}
+    tile_size = int(config.get("tile_size", TILE_SIZE))
+    # Objects are only seen whole if they fit in the halo, and the halo must stay within the neighbours
+    halo = min(int(config.get("tile_halo", TILE_HALO)), tile_size)
+    return {"dir": TILE_STATE_DIR, "size": tile_size, "halo": halo}
+
+def split_tiled_steps(steps):
+    """Split steps into image filters, the threshold step and the mask steps that follow.
+
+    Tiles can only be processed independently if the threshold is the one
+    image-wide quantity: the filters before it work on pixel neighbourhoods
+    and the steps after it on the mask. Returns None for other step lists.
+    """
+    for index, (command, options) in enumerate(steps):
+        if command in ("setAutoThreshold", "setThreshold"):
+            prefix, threshold_step, rest = steps[:index], steps[index], steps[index + 1:]
+            break
+        if command == "Convert to Mask":
+            # Without a threshold Convert to Mask picks one itself (Default unless its options say otherwise)
+            prefix, threshold_step, rest = steps[:index], ("setAutoThreshold", {"method": options.get("method", "Default"), "dark": options.get("dark", False)}), steps[index:]
+            break
+        if command not in TILE_PREFIX_COMMANDS:
+            return None
+    else:
+        return None
+    if any(command not in TILE_MASK_COMMANDS for command, _ in rest):
+        return None
+    return prefix, threshold_step, rest
+
+def count_native_plane_incremental(plane, steps, image_path, tiles, report=None):
+    """Count nuclei tile by tile, re-segmenting only tiles that changed since the last count.
+
+    Per-tile content hashes, histograms and counts are kept per image path in
+    tiles["dir"]. Each tile is segmented with a halo of surrounding pixels and
+    counts the objects whose centroid lies inside it, so every object is
+    counted once. Changed tiles and their neighbours are re-segmented. If
+    the image-wide threshold moves, every tile is. Returns (count, ROI area)
+    like count_native_plane, or None if the steps cannot be tiled.
+    """
+    split = split_tiled_steps(steps)
+    if split is None:
+        return None
+    prefix, threshold_step, rest = split
+    
+    roi = find_roi_definition(image_path)
+    roi_mask = None
+    roi_area = plane.shape[0] * plane.shape[1]
+    if roi:
+        bounds, roi_mask, roi_area = build_native_roi(roi, plane.shape)
+        plane = plane[bounds]
+    
+    tile_size, halo = tiles["size"], tiles["halo"]
+    height, width = plane.shape
+    state_path = os.path.join(tiles["dir"], hashlib.sha1(os.path.abspath(image_path).encode("utf-8")).hexdigest() + ".json")
+    state_key = hashlib.sha1(json.dumps([repr(steps), roi, tile_size, halo], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    state = None
+    try:
+        with open(state_path, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if not state or state.get("key") != state_key:
+        state = {"key": state_key, "threshold": None, "tiles": {}}
+    
+    grid = [(row, col) for row in range(math.ceil(height / tile_size)) for col in range(math.ceil(width / tile_size))]
+    hashes = {}
+    for row, col in grid:
+        core = plane[row * tile_size:(row + 1) * tile_size, col * tile_size:(col + 1) * tile_size]
+        hashes[f"{row},{col}"] = hashlib.sha1(f"{core.shape}".encode("utf-8") + np.ascontiguousarray(core).tobytes()).hexdigest()
+    stored = {name: tile for name, tile in state["tiles"].items() if name in hashes}
+    changed = {name for name in hashes if stored.get(name, {}).get("hash") != hashes[name]}
+    # Objects reach at most one tile into the neighbours, so those need re-segmenting too
+    dirty = {f"{row + dy},{col + dx}" for name in changed for row, col in [map(int, name.split(","))]
+             for dy in (-1, 0, 1) for dx in (-1, 0, 1)} & set(hashes)
+    
+    def window(name):
+        row, col = map(int, name.split(","))
+        y0, x0 = row * tile_size, col * tile_size
+        y1, x1 = min(height, y0 + tile_size), min(width, x0 + tile_size)
+        outer = (slice(max(0, y0 - halo), min(height, y1 + halo)), slice(max(0, x0 - halo), min(width, x1 + halo)))
+        core = (slice(y0 - outer[0].start, y1 - outer[0].start), slice(x0 - outer[1].start, x1 - outer[1].start))
+        return outer, core
+    
+    def filter_window(outer):
+        image = plane[outer]
+        for command, options in prefix:
+            image = apply_native_filter(image, command, options)
+        return image
+    
+    # Filtered windows are reused for segmentation while they fit in memory
+    filtered = {}
+    filtered_bytes = 0
+    for name in dirty:
+        outer, core = window(name)
+        image = filter_window(outer)
+        if filtered_bytes + image.nbytes <= TILE_FILTER_CACHE_BYTES:
+            filtered[name] = image
+            filtered_bytes += image.nbytes
+        stored[name] = {"hash": hashes[name], "histogram": np.bincount(image[core].ravel(), minlength=256).tolist()}
+    
+    command, options = threshold_step
+    if command == "setThreshold":
+        threshold = [options["lower"], options["upper"]]
+    else:
+        histogram = np.sum([stored[name]["histogram"] for name in hashes], axis=0)
+        threshold = list(auto_threshold_range(None, options, histogram))
+    if threshold != state["threshold"]:
+        dirty = set(hashes)
+    
+    mask_steps = [("setThreshold", {"lower": threshold[0], "upper": threshold[1]})] + rest
+    for name in dirty:
+        outer, core = window(name)
+        image = filtered.pop(name, None)
+        if image is None:
+            image = filter_window(outer)
+        tile_report = {}
+        _, counted = run_native_pipeline(image, mask_steps, None if roi_mask is None else roi_mask[outer], tile_report)
+        count = 0
+        if counted is not None and counted.any():
+            labels, label_count = ndimage.label(counted, structure=np.ones((3, 3)))
+            for y, x in ndimage.center_of_mass(counted, labels, range(1, label_count + 1)):
+                if core[0].start <= int(y) < core[0].stop and core[1].start <= int(x) < core[1].stop:
+                    count += 1
+        stored[name]["count"] = count
+        stored[name]["watershed"] = tile_report.get("watershed")
+    
+    state.update({"threshold": threshold, "shape": [height, width], "tiles": stored})
+    try:
+        os.makedirs(tiles["dir"], exist_ok=True)
+        write_json_atomic(state_path, state)
+    except OSError as e:
+        print(f"[WARNING] Could not save tile state for {os.path.basename(image_path)}: {e}")
+    
+    print(f"[INFO] {os.path.basename(image_path)}: re-segmented {len(dirty)}/{len(hashes)} tiles")
+    if report is not None:
+        decisions = [tile.get("watershed") for tile in stored.values()]
+        if any(decision and decision.startswith("auto") for decision in decisions):
+            split_tiles = sum(1 for decision in decisions if decision and not decision.startswith("auto:0/"))
+            report["watershed"] = f"auto:{split_tiles}/{len(decisions)} tiles"
+        else:
+            report["watershed"] = decisions[0] if decisions else "off"
+        report["tiles"] = f"{len(dirty)}/{len(hashes)}"
+    return sum(tile["count"] for tile in stored.values()), roi_area
+
+MACRO_NO_OP_COMMANDS = ("Threshold...", "Clear Results", "Select None", "Close All")
+MACRO_NO_OP_FUNCTIONS = ("print", "setBatchMode", "setOption", "resetThreshold")
+
+def split_macro_statements(macro_text):
+    """Split macro source into (line number, statement) pairs, dropping comments.
+
+    A newline only ends a statement outside parentheses, so calls wrapped
+    over several lines stay whole; a semicolon always ends one.
+    """
+    statements = []
+    current = ""
+    line_number = 1
+    start_line = 1
+    in_string = False
+    depth = 0
+    i = 0
+    while i < len(macro_text):
+        char = macro_text[i]
+        if in_string:
+            current += char
+            if char == "\\" and i + 1 < len(macro_text):
+                current += macro_text[i + 1]
+                i += 1
+            elif char == '"':
+                in_string = False
+        elif macro_text.startswith("//", i):
+            while i < len(macro_text) and macro_text[i] != "\n":
+                i += 1
+            continue
+        elif macro_text.startswith("/*", i):
+            end = macro_text.find("*/", i + 2)
+            end = len(macro_text) if end == -1 else end + 2
+            line_number += macro_text.count("\n", i, end)
+            i = end
+            continue
+        elif char == '"':
+            in_string = True
+            current += char
+        elif char == "\n" and depth > 0:
+            current += " "
+        elif char in ";\n":
+            if current.strip():
+                statements.append((start_line, current.strip()))
+            current = ""
+            depth = 0
+        else:
+            if not current.strip():
+                start_line = line_number
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth = max(0, depth - 1)
+            current += char
+        if char == "\n":
+            line_number += 1
+        i += 1
+    if current.strip():
+        statements.append((start_line, current.strip()))
+    return statements
+
+def parse_macro_arguments(argument_text):
+    """Parse a macro call's arguments. Returns a list of literals, or None for expressions."""
+    # Split on commas outside strings; each argument must then be a single literal
+    tokens = re.findall(r'(?:"(?:[^"\\]|\\.)*"|[^",])+', argument_text)
+    arguments = []
+    for token in (token.strip() for token in tokens):
+        if re.fullmatch(r'"(?:[^"\\]|\\.)*"', token):
+            arguments.append(token[1:-1])
+        elif token in ("true", "false"):
+            arguments.append(token == "true")
+        elif re.fullmatch(r"[-+]?\d+(?:\.\d+)?", token):
+            arguments.append(float(token))
+        else:
+            return None
+    return arguments
+
+def parse_macro_options(options_text):
+    """Parse an ImageJ options string like "size=450-25000 circularity=0.3-1.00 exclude"."""
+    options = {}
+    for match in re.finditer(r"(\w+)(?:=(\[[^\]]*\]|\S+))?", options_text):
+        key, value = match.group(1), match.group(2)
+        options[key] = value.strip("[]") if value is not None else True
+    return options
+
+def parse_macro_range(value, default):
+    """Parse an ImageJ "min-max" range such as 450-Infinity."""
+    try:
+        low, high = str(value).split("-", 1)
+        return (float(low), float("inf") if high.lower() == "infinity" else float(high))
+    except (ValueError, AttributeError):
+        return default
+
+def translate_mask_options(options):
+    """Translate Convert to Mask / Make Binary options, or return None if they have no native equivalent.
+
+    The method and background only apply when no threshold has been set,
+    exactly like the auto-threshold of a setAutoThreshold step.
+    """
+    if set(options) - {"method", "background", "calculate"}:
+        return None
+    method = options.get("method", "Default")
+    background = options.get("background", "Light")
+    if method not in ("Default", "Otsu") or background not in ("Dark", "Light"):
+        return None
+    return {"method": method, "dark": background == "Dark"} if options else {}
+
+def translate_macro(macro_text):
+    """Translate common ImageJ macro commands into native processing steps.
+
+    Returns (steps, unsupported) where unsupported lists (line number,
+    statement) pairs that have no native equivalent. If unsupported is not
+    empty the macro has to run in ImageJ.
+    """
+    steps = []
+    unsupported = []
+    for line_number, statement in split_macro_statements(macro_text):
+        call = re.fullmatch(r"(\w+)\s*\((.*)\)", statement, re.S)
+        if statement.replace(" ", "") == "open(getArgument())" or re.fullmatch(r"\w+\s*=\s*nResults", statement):
+            continue
+        if call is None:
+            unsupported.append((line_number, statement))
+            continue
+        
+        function, arguments = call.group(1), parse_macro_arguments(call.group(2))
+        if function in MACRO_NO_OP_FUNCTIONS:
+            continue
+        if arguments is None:
+            unsupported.append((line_number, statement))
+            continue
+        
+        if function == "run" and arguments:
+            command = arguments[0]
+            options = parse_macro_options(arguments[1]) if len(arguments) > 1 else {}
+            if command in MACRO_NO_OP_COMMANDS:
+                continue
+            if command in ("Convert to Mask", "Make Binary"):
+                mask_options = translate_mask_options(options)
+                if mask_options is None:
+                    unsupported.append((line_number, statement))
+                else:
+                    steps.append(("Convert to Mask", mask_options))
+            elif command in ("8-bit", "Invert", "Watershed", "Fill Holes"):
+                steps.append((command, {}))
+            elif command == "Median..." and "radius" in options:
+                steps.append(("Median...", {"radius": float(options["radius"])}))
+            elif command == "Gaussian Blur..." and "sigma" in options:
+                steps.append(("Gaussian Blur...", {"sigma": float(options["sigma"])}))
+            elif command == "Analyze Particles...":
+                steps.append(("Analyze Particles...", {
+                    "size": parse_macro_range(options.get("size", "0-Infinity"), (0, float("inf"))),
+                    "circularity": parse_macro_range(options.get("circularity", "0.00-1.00"), (0.0, 1.0)),
+                    "exclude": "exclude" in options,
+                    "include": "include" in options
+                }))
+            else:
+                unsupported.append((line_number, statement))
+        elif function == "setAutoThreshold" and arguments:
+            method, _, flags = str(arguments[0]).partition(" ")
+            if method not in ("Default", "Otsu"):
+                unsupported.append((line_number, statement))
+                continue
+            steps.append(("setAutoThreshold", {"method": method, "dark": "dark" in flags.split()}))
+        elif function == "setThreshold" and len(arguments) >= 2:
+            steps.append(("setThreshold", {"lower": arguments[0], "upper": arguments[1]}))
+        else:
+            unsupported.append((line_number, statement))
+    
+    if not any(command == "Analyze Particles..." for command, _ in steps):
+        unsupported.append((0, 'no run("Analyze Particles...") to count with'))
+    return steps, unsupported
+
+def get_native_steps(macro_path, settings):
+    """Native steps for the current settings, or None if the custom macro needs ImageJ."""
+    if macro_path and os.path.exists(macro_path) and not settings.get("disable_macro", False):
+        try:
+            with open(macro_path, "r") as f:
+                steps, unsupported = translate_macro(f.read())
+        except Exception as e:
+            print(f"[WARNING] Could not read custom macro: {e}")
+            return None
+        if unsupported:
+            print(f"[INFO] Custom macro needs ImageJ; unsupported commands in {os.path.basename(macro_path)}:")
+            for line_number, statement in unsupported[:10]:
+                print(f"[INFO]   line {line_number}: {statement}")
+            if len(unsupported) > 10:
+                print(f"[INFO]   ... and {len(unsupported) - 10} more")
+            return None
+        return steps
+    return get_builtin_native_steps(settings.get("use_watershed", True))
+
+PIXEL_CACHE_HEADER = struct.Struct("<II")
+
+def get_pixel_cache(settings, config=None):
+    """Pixel cache options for the native engine, or None if caching is off."""
+    if not settings.get("pixel_cache", False):
+        return None
+    max_mb = (config or {}).get("pixel_cache_mb", PIXEL_CACHE_MAX_MB)
+    return {"dir": PIXEL_CACHE_DIR, "max_bytes": int(max_mb) * 1024 * 1024}
+
+def hash_file(path):
+    """Return the SHA-1 of a file's content."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def evict_pixel_cache(cache_dir, max_bytes, keep=None):
+    """Delete least recently used cached planes until the cache fits max_bytes."""
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, "*.u8")):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def decode_image_plane_cached(image_path, channel=0, cache=None):
+    """Decode an image, reading and filling the on-disk pixel cache.
+
+    Cached planes are raw 8-bit arrays keyed by the source file's content
+    hash and channel and are opened with np.memmap, so a hit costs almost
+    nothing. A small pointer file per source path remembers its size, mtime
+    and key, so unchanged files skip hashing. Returns (plane, "hit" / "miss", or None when caching is off).
+    """
+    if cache is None:
+        return decode_image_plane(image_path, channel), None
+    
+    cache_dir = cache["dir"]
+    stat = os.stat(image_path)
+    source_id = hashlib.sha1(f"{os.path.abspath(image_path)}:{channel}".encode("utf-8")).hexdigest()
+    pointer_path = os.path.join(cache_dir, f"{source_id}.src")
+    pointer = None
+    try:
+        with open(pointer_path, "r") as f:
+            pointer = json.load(f)
+    except (OSError, ValueError):
+        pass
+    
+    if pointer and pointer.get("size") == stat.st_size and pointer.get("mtime_ns") == stat.st_mtime_ns:
+        key = pointer["key"]
+    else:
+        # A changed source just points at a new key; the old plane may be shared
+        # with other paths of the same content, so only LRU eviction removes it
+        key = hashlib.sha1(f"{hash_file(image_path)}:{channel}".encode("utf-8")).hexdigest()
+    entry_path = os.path.join(cache_dir, f"{key}.u8")
+    
+    try:
+        with open(entry_path, "rb") as f:
+            height, width = PIXEL_CACHE_HEADER.unpack(f.read(PIXEL_CACHE_HEADER.size))
+        plane = np.memmap(entry_path, dtype=np.uint8, mode="r", offset=PIXEL_CACHE_HEADER.size, shape=(height, width))
+        # Mark as recently used for eviction
+        os.utime(entry_path)
+        result = "hit"
+    except (OSError, ValueError, struct.error):
+        plane = decode_image_plane(image_path, channel)
+        result = "miss"
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(PIXEL_CACHE_HEADER.pack(*plane.shape))
+                f.write(np.ascontiguousarray(plane, dtype=np.uint8).tobytes())
+            os.replace(temp_path, entry_path)
+            evict_pixel_cache(cache_dir, cache["max_bytes"], keep=entry_path)
+        except OSError as e:
+            print(f"[WARNING] Could not cache pixels for {os.path.basename(image_path)}: {e}")
+    
+    if not pointer or pointer.get("key") != key or pointer.get("mtime_ns") != stat.st_mtime_ns:
+        try:
+            write_json_atomic(pointer_path, {"key": key, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+        except OSError:
+            pass
+    return plane, result
+
+def native_decode_worker(job_queue, free_queue, ready_queue, result_queue, slot_bytes, channel=0, cache=None):
+    """Decode images into pooled shared-memory buffers and pass on small descriptors."""
+    attached = {}
+    try:
+        while True:
+            job = job_queue.get()
+            if job is None:
+                break
+            job_id, image_path = job
+            start = time.time()
+            try:
+                plane, cache_result = decode_image_plane_cached(image_path, channel, cache)
+            except Exception as e:
+                result_queue.put({"job_id": job_id, "count": None, "error": f"decode failed: {e}", "reason": "decode_failed"})
+                continue
+            decode_ms = (time.time() - start) * 1000
+            
+            if plane.nbytes > slot_bytes:
+                # Larger than a pooled buffer: let the counting worker decode it itself
+                ready_queue.put({"job_id": job_id, "image_path": image_path, "name": None, "decode_ms": 0.0, "cache": None})
+                continue
+            
+            # Blocks while every buffer is in use, which keeps memory bounded
+            name = free_queue.get()
+            if name not in attached:
+                attached[name] = shared_memory.SharedMemory(name=name)
+            target = np.ndarray(plane.shape, dtype=plane.dtype, buffer=attached[name].buf)
+            target[...] = plane
+            del target
+            ready_queue.put({
+                "job_id": job_id,
+                "image_path": image_path,
+                "name": name,
+                "shape": plane.shape,
+                "dtype": plane.dtype.str,
+                "decode_ms": decode_ms,
+                "cache": cache_result
+            })
+    finally:
+        for shm in attached.values():
+            shm.close()
+
+def native_count_worker(ready_queue, free_queue, result_queue, steps, qc_run_id, channel=0, cache=None, tiles=None):
+    """Count nuclei from shared-memory descriptors and recycle the buffers."""
+    attached = {}
+    try:
+        while True:
+            descriptor = ready_queue.get()
+            if descriptor is None:
+                break
+            job_id = descriptor["job_id"]
+            image_path = descriptor["image_path"]
+            start = time.time()
+            cache_result = descriptor["cache"]
+            try:
+                if descriptor["name"] is None:
+                    plane, cache_result = decode_image_plane_cached(image_path, channel, cache)
+                else:
+                    name = descriptor["name"]
+                    if name not in attached:
+                        attached[name] = shared_memory.SharedMemory(name=name)
+                    plane = np.ndarray(descriptor["shape"], dtype=np.dtype(descriptor["dtype"]), buffer=attached[name].buf)
+                report = {}
+                count, roi_area = count_native_plane(plane, steps, image_path, qc_run_id, report, tiles)
+                height, width = plane.shape
+                del plane
+                result_queue.put({
+                    "job_id": job_id,
+                    "count": count,
+                    "width": width,
+                    "height": height,
+                    "roi_area": roi_area,
+                    "millis": descriptor["decode_ms"] + (time.time() - start) * 1000,
+                    "cache": cache_result,
+                    "watershed": report.get("watershed"),
+                    "qc_path": report.get("qc_path")
+                })
+            except Exception as e:
+                result_queue.put({"job_id": job_id, "count": None, "error": str(e)})
+            finally:
+                if descriptor["name"] is not None:
+                    free_queue.put(descriptor["name"])
+    finally:
+        for shm in attached.values():
+            shm.close()
+
+def count_multiple_nuclei_native(image_paths, use_watershed=True, save_qc=True, details=None, decode_workers=None, count_workers=None, steps=None, channel=0, cache=None, tiles=None):
+    """Count nuclei in-process without ImageJ.
+
+    With more than one image, decoding and counting run in separate worker
+    processes. Decoded frames are handed over through a pool of shared-memory
+    buffers so only small descriptors travel through the queues. cache is
+    the pixel cache from get_pixel_cache, or None to always decode; tiles
+    enables incremental counting (see get_tile_options).
+    """
+    if not native_engine_available():
+        print("[ERROR] Native engine requires numpy, scipy and Pillow")
+        return {}
+    if not image_paths:
+        return {}
+    
+    steps = steps or get_builtin_native_steps(use_watershed)
+    qc_run_id = None
+    if save_qc:
+        os.makedirs(QC_DIR, exist_ok=True)
+        qc_run_id = new_qc_run_id()
+    print(f"[STEP] Counting {len(image_paths)} images with the native engine")
+    
+    cpu_count = os.cpu_count() or 2
+    decode_workers = decode_workers or max(1, cpu_count // 4)
+    count_workers = count_workers or max(1, cpu_count - decode_workers)
+    sequential = len(image_paths) == 1 or cpu_count == 1
+    # Pipelined images are counted side by side, so each one costs the session only a share of its time
+    parallelism = 1 if sequential else min(count_workers, len(image_paths))
+    
+    session_start = time.time()
+    results = {}
+    image_timings = []
+    
+    def record(image_path, result):
+        filename = os.path.basename(image_path)
+        results[filename] = result.get("count")
+        if result.get("cache"):
+            metric_inc("nuclei_counter_cache_requests_total", cache="pixels", result=result["cache"])
+        if result.get("count") is None:
+            record_image_metrics("native", reason=result.get("reason", "processing_error"))
+            print(f"[ERROR] Processing failed for: {filename} ({result.get('error')})")
+            return
+        record_image_metrics("native", result["millis"] / 1000)
+        print(f"[SUCCESS] {filename}: {result['count']}")
+        timing = {"filename": filename, "width": result["width"], "height": result["height"], "millis": result["millis"], "roi_area": result["roi_area"]}
+        image_timings.append(dict(timing, millis=result["millis"] / parallelism))
+        if details is not None:
+            details[filename] = dict(timing, engine="native", watershed=result.get("watershed"), qc_path=result.get("qc_path"))
+    
+    if sequential:
+        for image_path in image_paths:
+            start = time.time()
+            try:
+                plane, cache_result = decode_image_plane_cached(image_path, channel, cache)
+            except Exception as e:
+                record(image_path, {"count": None, "error": f"decode failed: {e}", "reason": "decode_failed"})
+                continue
+            try:
+                report = {}
+                count, roi_area = count_native_plane(plane, steps, image_path, qc_run_id, report, tiles)
+                record(image_path, {"count": count, "width": plane.shape[1], "height": plane.shape[0], "roi_area": roi_area,
+                                    "millis": (time.time() - start) * 1000, "cache": cache_result, "watershed": report.get("watershed"),
+                                    "qc_path": report.get("qc_path")})
+            except Exception as e:
+                record(image_path, {"count": None, "error": str(e)})
+    else:
+        decode_workers = min(decode_workers, len(image_paths))
+        count_workers = min(count_workers, len(image_paths))
+        sizes = [read_image_size(path) for path in image_paths]
+        slot_bytes = max([width * height for width, height in filter(None, sizes)] or [4096 * 4096])
+        
+        context = multiprocessing.get_context("spawn")
+        job_queue = context.Queue()
+        ready_queue = context.Queue()
+        free_queue = context.Queue()
+        result_queue = context.Queue()
+        
+        # Enough buffers for every worker to hold one frame plus one waiting in the queue
+        pool = [shared_memory.SharedMemory(create=True, size=slot_bytes) for _ in range(decode_workers + count_workers + 1)]
+        processes = []
+        try:
+            for shm in pool:
+                free_queue.put(shm.name)
+            for job_id, image_path in enumerate(image_paths):
+                job_queue.put((job_id, image_path))
+            for _ in range(decode_workers):
+                job_queue.put(None)
+            
+            processes += [context.Process(target=native_decode_worker, args=(job_queue, free_queue, ready_queue, result_queue, slot_bytes, channel, cache), daemon=True)
+                          for _ in range(decode_workers)]
+            processes += [context.Process(target=native_count_worker, args=(ready_queue, free_queue, result_queue, steps, qc_run_id, channel, cache, tiles), daemon=True)
+                          for _ in range(count_workers)]
+            for process in processes:
+                process.start()
+            
+            pending = set(range(len(image_paths)))
+            while pending:
+                try:
+                    result = result_queue.get(timeout=1)
+                except queue.Empty:
+                    if any(process.exitcode not in (None, 0) for process in processes):
+                        print("[ERROR] A native worker process exited unexpectedly")
+                        break
+                    continue
+                pending.discard(result["job_id"])
+                metric_set("nuclei_counter_queue_depth", len(pending), queue="native_pipeline")
+                record(image_paths[result["job_id"]], result)
+            for job_id in sorted(pending):
+                record(image_paths[job_id], {"count": None, "error": "worker failed", "reason": "worker_failed"})
+            metric_set("nuclei_counter_queue_depth", 0, queue="native_pipeline")
+            
+            for _ in range(count_workers):
+                ready_queue.put(None)
+            for process in processes:
+                process.join(timeout=10)
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for shm in pool:
+                shm.close()
+                shm.unlink()
+    
+    record_session_timings("native", image_timings, time.time() - session_start, {"use_watershed": use_watershed, "channel": channel})
+    return results
+
+COUNTING_ENGINES = ("imagej", "native", "stub")
+SHARD_STALE_SECONDS = 600
+SHARD_POLL_SECONDS = 5
+SHARD_MAX_ATTEMPTS = 3
+
+def run_counting_engine(engine, image_paths, settings, config=None, allow_multiple=False, details=None):
+    """Count nuclei with the named engine and return {filename: count}.
+
+    If details is a dict it is filled with per-image information (engine,
+    size, time, ROI area) by engines that report it.
+    """
+    if engine == "stub":
+        return count_multiple_nuclei_stub(image_paths, details)
+    if engine == "native":
+        steps = get_native_steps((config or {}).get("macro_path"), settings)
+        if steps is None:
+            print("[INFO] Falling back to ImageJ for the custom macro.")
+            return run_counting_engine("imagej", image_paths, settings, config, allow_multiple, details)
+        return count_multiple_nuclei_native(image_paths, use_watershed=settings.get("use_watershed", True), details=details, steps=steps,
+                                            channel=settings.get("channel", 0), cache=get_pixel_cache(settings, config),
+                                            tiles=get_tile_options(settings, config))
+    if engine == "imagej":
+        config = config or get_config()
+        return count_multiple_nuclei_with_imagej(
+            image_paths, config.get("macro_path"), config["imagej_path"],
+            keep_images_open=False,
+            use_watershed=settings.get("use_watershed", True),
+            disable_macro=settings.get("disable_macro", False),
+            allow_multiple=allow_multiple,
+            channel=settings.get("channel", 0),
+            details=details
+        )
+    print(f"[ERROR] Unknown counting engine: {engine}")
+    return {}
+
+def read_tiff_ifd(f, byte_order, offset):
+    """Read one TIFF IFD. Returns ({tag: [values]}, next_ifd_offset)."""
+    type_formats = {1: "B", 3: "H", 4: "I", 16: "Q"}
+    f.seek(offset)
+    (entry_count,) = struct.unpack(byte_order + "H", f.read(2))
+    tags = {}
+    for _ in range(entry_count):
+        tag, value_type, value_count, value_field = struct.unpack(byte_order + "HHI4s", f.read(12))
+        fmt = type_formats.get(value_type)
+        if fmt is None:
+            continue
+        size = struct.calcsize(fmt) * value_count
+        if size <= 4:
+            data = value_field[:size]
+        else:
+            position = f.tell()
+            f.seek(struct.unpack(byte_order + "I", value_field)[0])
+            data = f.read(size)
+            f.seek(position)
+        tags[tag] = list(struct.unpack(byte_order + fmt * value_count, data))
+    (next_offset,) = struct.unpack(byte_order + "I", f.read(4))
+    return tags, next_offset
+
+def read_image_size(image_path):
+    """Read (width, height) from an image header without decoding pixels. Returns None if unknown."""
+    try:
+        with open(image_path, "rb") as f:
+            head = f.read(26)
+            if head[:8] == b"\x89PNG\r\n\x1a\n":
+                return struct.unpack(">II", head[16:24])
+            if head[:2] == b"BM":
+                width, height = struct.unpack("<ii", head[18:26])
+                return width, abs(height)
+            if head[:4] in (b"II*\x00", b"MM\x00*"):
+                byte_order = "<" if head[:2] == b"II" else ">"
+                tags, _ = read_tiff_ifd(f, byte_order, struct.unpack(byte_order + "I", head[4:8])[0])
+                return tags[256][0], tags[257][0]
+            if head[:2] == b"\xff\xd8":
+                f.seek(2)
+                while True:
+                    marker = f.read(2)
+                    if len(marker) < 2 or marker[0] != 0xFF:
+                        return None
+                    code = marker[1]
+                    if code == 0xFF:
+                        f.seek(-1, 1)
+                        continue
+                    if code == 0x01 or 0xD0 <= code <= 0xD8:
+                        continue
+                    (length,) = struct.unpack(">H", f.read(2))
+                    # Start-of-frame markers carry the image dimensions
+                    if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                        height, width = struct.unpack(">xHH", f.read(5))
+                        return width, height
+                    f.seek(length - 2, 1)
+    except Exception as e:
+        print(f"[DEBUG] Could not read image size for {image_path}: {e}")
+    return None
+
+def get_timing_records():
+    """Load recorded per-session timings."""
+    if os.path.exists(TIMINGS_FILE):
+        try:
+            with open(TIMINGS_FILE, "r") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"[ERROR] Failed to load timings: {e}")
+    return []
+
+TIMINGS_LOCK = threading.Lock()
+
+def record_session_timings(engine, image_timings, wall_seconds, settings):
+    """Record the per-image timings of one counting session for the planner."""
+    images = [{"pixels": t["width"] * t["height"], "millis": t["millis"]} for t in image_timings if t.get("width")]
+    if not images:
+        return
+    record = {
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "engine": engine,
+        "settings": settings,
+        "wall_seconds": round(wall_seconds, 3),
+        "images": images
+    }
+    try:
+        with TIMINGS_LOCK:
+            records = get_timing_records()
+            records.append(record)
+            # Keep only the most recent sessions so the model follows hardware changes
+            write_json_atomic(TIMINGS_FILE, records[-200:])
+    except Exception as e:
+        print(f"[ERROR] Failed to record timings: {e}")
+
+DEFAULT_ENGINE_COSTS = {
+    "imagej": {"session_seconds": 10.0, "per_image_ms": 150.0, "per_megapixel_ms": 250.0},
+    "native": {"session_seconds": 1.5, "per_image_ms": 50.0, "per_megapixel_ms": 1000.0}
+}
+AUTO_ENGINES = ("imagej",)
+PLANNER_SETTING_KEYS = ("use_watershed", "channel")
+PLANNER_MAX_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+
+def get_auto_engines(macro_path, disable_macro, allow_native=False):
+    """Engines the planner may choose from for the current processing settings.
+
+    The native engine is opt-in (allow_native) until its counts have been
+    checked against ImageJ on reference images.
+    """
+    # The native engine only runs macros whose commands all translate
+    if allow_native and native_engine_available() and get_native_steps(macro_path, {"disable_macro": disable_macro}) is not None:
+        return ("imagej", "native")
+    return AUTO_ENGINES
+
+def fit_cost_model(engine, settings):
+    """Fit session overhead and per-image cost (fixed + per megapixel) from recorded timings."""
+    records = [r for r in get_timing_records() if r.get("engine") == engine]
+    matching = [r for r in records if all(r.get("settings", {}).get(key) == settings.get(key) for key in PLANNER_SETTING_KEYS)] or records
+    points = [(image["pixels"], image["millis"]) for r in matching for image in r["images"]]
+    model = dict(DEFAULT_ENGINE_COSTS.get(engine, DEFAULT_ENGINE_COSTS["imagej"]))
+    model["samples"] = len(points)
+    if len(points) < 3:
+        return model
+    
+    # Least-squares fit of millis = a + b * pixels, kept non-negative
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x if var_x else 0.0
+    intercept = mean_y - slope * mean_x
+    if slope < 0:
+        slope, intercept = 0.0, mean_y
+    elif intercept < 0:
+        slope, intercept = mean_y / mean_x if mean_x else 0.0, 0.0
+    model["per_image_ms"] = intercept
+    model["per_megapixel_ms"] = slope * 1e6
+    
+    overheads = [r["wall_seconds"] - sum(image["millis"] for image in r["images"]) / 1000 for r in matching]
+    model["session_seconds"] = max(0.0, statistics.median(overheads))
+    return model
+
+def get_plan_log():
+    """Load audited plans (predicted vs actual run times)."""
+    plans = []
+    if os.path.exists(PLAN_LOG_FILE):
+        try:
+            with open(PLAN_LOG_FILE, "r") as f:
+                plans = [json.loads(line) for line in f if line.strip()]
+        except Exception as e:
+            print(f"[ERROR] Failed to load plan log: {e}")
+    return plans
+
+def get_parallel_slowdown(engine, workers):
+    """Estimate how much parallel sessions slow each other down, from past audited plans."""
+    ratios = [p["actual_seconds"] / p["ideal_seconds"] for p in get_plan_log()
+              if p.get("engine") == engine and p.get("workers") == workers and p.get("ideal_seconds")]
+    if ratios:
+        return statistics.median(ratios)
+    return 1.0 + 0.15 * (workers - 1)
+
+def predict_batch_seconds(model, pixel_counts):
+    """Predict the run time of a single session processing images of the given sizes."""
+    work_ms = sum(model["per_image_ms"] + model["per_megapixel_ms"] * pixels / 1e6 for pixels in pixel_counts)
+    return model["session_seconds"] + work_ms / 1000
+
+def plan_counting_run(image_paths, settings, engines=AUTO_ENGINES, max_workers=PLANNER_MAX_WORKERS):
+    """Choose engine, worker count and batch size that minimise predicted wall-clock time."""
+    sizes = [read_image_size(path) for path in image_paths]
+    known = [width * height for width, height in filter(None, sizes)]
+    fallback_pixels = statistics.median(known) if known else 4e6
+    pixel_counts = [size[0] * size[1] if size else fallback_pixels for size in sizes]
+    total = len(image_paths)
+    
+    best = None
+    for engine in engines:
+        model = fit_cost_model(engine, settings)
+        # The native engine parallelises internally, so only ImageJ runs side-by-side sessions
+        worker_limit = min(max_workers, total) if engine == "imagej" else 1
+        for workers in range(1, worker_limit + 1):
+            slowdown = get_parallel_slowdown(engine, workers)
+            # Use as few batches as possible while keeping every session under the ImageJ timeout
+            batches_per_worker = 1
+            while True:
+                batch_size = math.ceil(total / (workers * batches_per_worker))
+                batches = [pixel_counts[i:i + batch_size] for i in range(0, total, batch_size)]
+                batch_seconds = [predict_batch_seconds(model, batch) * slowdown for batch in batches]
+                if max(batch_seconds) < 0.8 * IMAGEJ_TIMEOUT_SECONDS or batch_size == 1:
+                    break
+                batches_per_worker += 1
+            
+            # Batches are handed to whichever worker frees up first
+            loads = [0.0] * workers
+            for seconds in batch_seconds:
+                loads[loads.index(min(loads))] += seconds
+            predicted = max(loads)
+            
+            if workers > 1:
+                strategy = "parallel-sessions"
+            elif len(batches) > 1:
+                strategy = "sequential-batches"
+            else:
+                strategy = "single-session"
+            
+            if best is None or predicted < best["predicted_seconds"]:
+                best = {
+                    "engine": engine,
+                    "strategy": strategy,
+                    "workers": workers,
+                    "batch_size": batch_size,
+                    "batches": len(batches),
+                    "images": total,
+                    "megapixels": round(sum(pixel_counts) / 1e6, 2),
+                    "predicted_seconds": round(predicted, 2),
+                    "ideal_seconds": round(predicted / slowdown, 2),
+                    "model": {key: round(value, 3) for key, value in model.items()}
+                }
+    return best
+
+def log_plan(plan, actual_seconds, settings):
+    """Append a plan with its predicted and actual run time to the audit log."""
+    entry = dict(plan)
+    entry["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    entry["settings"] = settings
+    entry["actual_seconds"] = round(actual_seconds, 2)
+    try:
+        with open(PLAN_LOG_FILE, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+    except Exception as e:
+        print(f"[ERROR] Failed to write plan log: {e}")
+
+def count_nuclei_with_plan(image_paths, settings, config=None, plan=None, engines=AUTO_ENGINES, details=None):
+    """Count nuclei using an automatically chosen strategy and audit the choice."""
+    if not image_paths:
+        return {}
+    plan = plan or plan_counting_run(image_paths, settings, engines)
+    print(f"[PLAN] Engine: {plan['engine']}, strategy: {plan['strategy']}, workers: {plan['workers']}, "
+          f"batch size: {plan['batch_size']}, predicted: {plan['predicted_seconds']:.1f}s")
+    
+    if plan["engine"] == "imagej" and config is None:
+        config = get_config()
+    batch_size = plan["batch_size"]
+    batches = [list(image_paths[i:i + batch_size]) for i in range(0, len(image_paths), batch_size)]
+    parallel = plan["workers"] > 1
+    
+    start = time.time()
+    results = {}
+    metric_set("nuclei_counter_queue_depth", len(batches), queue="planned_batches")
+    with ThreadPoolExecutor(max_workers=plan["workers"]) as executor:
+        for remaining, batch_results in enumerate(executor.map(lambda batch: run_counting_engine(plan["engine"], batch, settings, config, allow_multiple=parallel, details=details), batches)):
+            results.update(batch_results)
+            metric_set("nuclei_counter_queue_depth", len(batches) - remaining - 1, queue="planned_batches")
+    actual = time.time() - start
+    
+    print(f"[PLAN] Predicted {plan['predicted_seconds']:.1f}s, actual {actual:.1f}s")
+    log_plan(plan, actual, settings)
+    return results
+
+def select_and_count(keep_images_open=False, use_watershed=True, disable_macro=False, channel=0, pixel_cache=False, incremental=False, native_engine=False):
     """Select images and count nuclei in each using batch processing."""
     try:
         config = get_config()
@@ -545,7 +2480,18 @@ def select_and_count(keep_images_open=False, use_watershed=True, disable_macro=F
         
         print(f"[INFO] Processing {len(file_paths)} images in batch mode...")
         
-        batch_results = count_multiple_nuclei_with_imagej(file_paths, config["macro_path"], config["imagej_path"], keep_images_open, use_watershed, disable_macro)
+        details = {}
+        if keep_images_open:
+            # Inspection needs every image in one ImageJ session
+            batch_results = count_multiple_nuclei_with_imagej(file_paths, config["macro_path"], config["imagej_path"], keep_images_open, use_watershed, disable_macro, channel=channel, details=details)
+        else:
+            settings = {"use_watershed": use_watershed, "disable_macro": disable_macro, "channel": channel, "pixel_cache": pixel_cache, "incremental": incremental,
+                        "native_engine": native_engine}
+            if incremental and native_engine_available():
+                # Only the native engine keeps per-tile results between runs
+                batch_results = run_counting_engine("native", file_paths, settings, config, details=details)
+            else:
+                batch_results = count_nuclei_with_plan(file_paths, settings, config, engines=get_auto_engines(config["macro_path"], disable_macro, native_engine), details=details)
         
         results = []
         successful_counts = 0
@@ -555,7 +2501,8 @@ def select_and_count(keep_images_open=False, use_watershed=True, disable_macro=F
             count = batch_results.get(filename)
             
             if count is not None:
-                save_to_history(filename, count)
+                fields = get_result_fields(path, details.get(filename, {}), count)
+                save_to_history(filename, count, get_run_qc_path(details.get(filename, {})), fields)
                 results.append(f"{filename}: {count}")
                 successful_counts += 1
             else:
@@ -635,6 +2582,8 @@ def change_macro_settings():
         if macro_path and os.path.exists(macro_path):
             config["macro_path"] = macro_path
             print(f"[INFO] Macro file updated: {macro_path}")
+            if native_engine_available() and get_native_steps(macro_path, {}) is not None:
+                print("[INFO] All macro commands translate; the native engine can run this macro.")
         else:
             config["macro_path"] = None
             print("[INFO] Will use built-in macro.")
@@ -649,6 +2598,630 @@ def change_macro_settings():
     except Exception as e:
         print(f"[ERROR] Error changing macro settings: {e}")
 
+def get_shard_paths(shard_dir):
+    """Return the manifest, lock, result, merge-marker and results CSV locations of a shard job."""
+    return {
+        "manifest": os.path.join(shard_dir, "manifest.json"),
+        "locks": os.path.join(shard_dir, "locks"),
+        "results": os.path.join(shard_dir, "results"),
+        "merged": os.path.join(shard_dir, "merged"),
+        "csv": os.path.join(shard_dir, "results.csv"),
+        "merge_lock": os.path.join(shard_dir, "merge.lock")
+    }
+
+def create_shard_job(shard_dir, image_paths, engine="imagej", settings=None, chunk_size=8, stale_after=SHARD_STALE_SECONDS,
+                     max_attempts=SHARD_MAX_ATTEMPTS):
+    """Write a job manifest splitting image_paths into chunks for shard workers."""
+    paths = get_shard_paths(shard_dir)
+    if os.path.exists(paths["manifest"]):
+        print(f"[ERROR] Shard directory already contains a job: {shard_dir}")
+        return None
+    
+    for key in ("locks", "results", "merged"):
+        os.makedirs(paths[key], exist_ok=True)
+    
+    image_paths = [os.path.abspath(path) for path in image_paths]
+    chunk_size = max(1, int(chunk_size))
+    chunks = []
+    for start in range(0, len(image_paths), chunk_size):
+        chunks.append({
+            "chunk_id": f"chunk_{len(chunks):05d}",
+            "images": image_paths[start:start + chunk_size]
+        })
+    
+    manifest = {
+        "job_id": uuid.uuid4().hex[:12],
+        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "engine": engine,
+        "settings": settings if settings is not None else get_processing_settings(),
+        "stale_after": stale_after,
+        "max_attempts": max_attempts,
+        "chunks": chunks
+    }
+    write_json_atomic(paths["manifest"], manifest)
+    print(f"[INFO] Shard job {manifest['job_id']} created: {len(image_paths)} images in {len(chunks)} chunks")
+    return manifest
+
+def load_shard_manifest(shard_dir):
+    """Load the job manifest from a shard directory."""
+    try:
+        with open(get_shard_paths(shard_dir)["manifest"], "r") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"[ERROR] Failed to load shard manifest: {e}")
+        return None
+
+def try_create_lock(lock_path, owner):
+    """Atomically create lock_path. Returns False if it already exists."""
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(owner)
+    return True
+
+def read_lock_owner(lock_path):
+    """Return the owner recorded in a lock file, or None if it is gone."""
+    try:
+        with open(lock_path, "r") as f:
+            return f.read().strip()
+    except Exception:
+        return None
+
+def is_lock_stale(lock_path, stale_after):
+    """Check whether a lock has not been refreshed within stale_after seconds."""
+    try:
+        return time.time() - os.path.getmtime(lock_path) > stale_after
+    except FileNotFoundError:
+        return False
+
+def steal_lock(lock_path, owner, stale_after):
+    """Take over a stale lock. Only one of several competing workers succeeds.
+
+    The stale check and the rename are separate steps, so another worker may
+    have stolen the lock in between. The moved-aside lock is checked again and
+    put back if it is no longer the stale lock that was seen.
+    """
+    stale_owner = read_lock_owner(lock_path)
+    if stale_owner is None:
+        return False
+    aside_path = f"{lock_path}.stale-{owner}-{time.time_ns()}"
+    try:
+        # Renaming is atomic, so exactly one worker moves a given lock aside
+        os.rename(lock_path, aside_path)
+    except FileNotFoundError:
+        return False
+    
+    if read_lock_owner(aside_path) != stale_owner or not is_lock_stale(aside_path, stale_after):
+        # Someone else took the lock over first: restore theirs and give up
+        try:
+            os.link(aside_path, lock_path)
+        except FileExistsError:
+            pass
+        os.unlink(aside_path)
+        return False
+    os.unlink(aside_path)
+    return try_create_lock(lock_path, owner)
+
+def release_lock(lock_path, owner):
+    """Delete a lock, but only if owner still holds it."""
+    if read_lock_owner(lock_path) != owner:
+        return False
+    try:
+        os.unlink(lock_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+def start_lock_heartbeat(lock_path, owner, interval):
+    """Keep refreshing a lock's mtime until the returned event is set."""
+    stop_event = threading.Event()
+    
+    def heartbeat():
+        while not stop_event.wait(interval):
+            current_owner = read_lock_owner(lock_path)
+            if current_owner is None:
+                # Possibly moved aside briefly by a worker checking for staleness
+                continue
+            if current_owner != owner:
+                print(f"[WARNING] Lost lock {os.path.basename(lock_path)}; finishing chunk anyway")
+                return
+            try:
+                os.utime(lock_path)
+            except Exception as e:
+                print(f"[DEBUG] Heartbeat failed for {lock_path}: {e}")
+    
+    threading.Thread(target=heartbeat, daemon=True).start()
+    return stop_event
+
+def shard_result_path(shard_dir, chunk_id):
+    """Return where the result of a chunk is published."""
+    return os.path.join(get_shard_paths(shard_dir)["results"], f"{chunk_id}.json")
+
+def claim_shard_chunk(shard_dir, manifest, worker_id, skip=()):
+    """Claim the next chunk without a result: unclaimed chunks first, then stale ones.
+
+    Chunks whose IDs are in skip (ones this worker already failed) are left to others.
+    """
+    paths = get_shard_paths(shard_dir)
+    pending = [chunk for chunk in manifest["chunks"]
+               if chunk["chunk_id"] not in skip and not os.path.exists(shard_result_path(shard_dir, chunk["chunk_id"]))]
+    
+    for chunk in pending:
+        lock_path = os.path.join(paths["locks"], f"{chunk['chunk_id']}.lock")
+        if try_create_lock(lock_path, worker_id):
+            return chunk, lock_path
+    
+    for chunk in pending:
+        lock_path = os.path.join(paths["locks"], f"{chunk['chunk_id']}.lock")
+        if is_lock_stale(lock_path, manifest.get("stale_after", SHARD_STALE_SECONDS)):
+            if steal_lock(lock_path, worker_id, manifest.get("stale_after", SHARD_STALE_SECONDS)):
+                print(f"[INFO] Stole stale chunk {chunk['chunk_id']}")
+                return chunk, lock_path
+    
+    return None, None
+
+def record_shard_attempt(shard_dir, chunk_id, worker_id):
+    """Record a failed attempt at a chunk in the lock directory. Returns attempts so far."""
+    locks_dir = get_shard_paths(shard_dir)["locks"]
+    # One file per attempt, so concurrent workers never lose a count
+    prefix = f"{chunk_id}.attempt-"
+    with open(os.path.join(locks_dir, f"{prefix}{worker_id}-{time.time_ns()}"), "w") as f:
+        f.write(worker_id)
+    return sum(1 for name in os.listdir(locks_dir) if name.startswith(prefix))
+
+def publish_shard_result(shard_dir, chunk_id, payload):
+    """Publish a chunk result exactly once. Returns False if another worker got there first."""
+    result_path = shard_result_path(shard_dir, chunk_id)
+    temp_path = f"{result_path}.{payload['worker_id']}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(payload, f, indent=2)
+    try:
+        # A hard link fails if the target exists, unlike os.replace
+        os.link(temp_path, result_path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.unlink(temp_path)
+
+def run_shard_worker(shard_dir, worker_id=None, config=None, poll_seconds=SHARD_POLL_SECONDS):
+    """Claim and process chunks from a shard job until every chunk has a result."""
+    manifest = load_shard_manifest(shard_dir)
+    if manifest is None:
+        return 0
+    
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    if manifest["engine"] == "imagej" and config is None:
+        config = get_config()
+    stale_after = manifest.get("stale_after", SHARD_STALE_SECONDS)
+    max_attempts = manifest.get("max_attempts", SHARD_MAX_ATTEMPTS)
+    completed = 0
+    failed_chunks = set()
+    print(f"[INFO] Shard worker {worker_id} joined job {manifest['job_id']}")
+    
+    while True:
+        pending = sum(1 for c in manifest["chunks"] if not os.path.exists(shard_result_path(shard_dir, c["chunk_id"])))
+        metric_set("nuclei_counter_queue_depth", pending, queue="shard_chunks")
+        chunk, lock_path = claim_shard_chunk(shard_dir, manifest, worker_id, failed_chunks)
+        if chunk is None:
+            unfinished = {c["chunk_id"] for c in manifest["chunks"] if not os.path.exists(shard_result_path(shard_dir, c["chunk_id"]))}
+            if not unfinished:
+                break
+            if unfinished <= failed_chunks:
+                # Nothing else is left to do, so retry until the chunks succeed or run out of attempts
+                print(f"[INFO] Worker {worker_id} retrying {len(failed_chunks)} chunks that failed here")
+                failed_chunks.clear()
+                continue
+            # Remaining chunks are held by live workers; wait in case one goes stale
+            time.sleep(poll_seconds)
+            continue
+        
+        print(f"[STEP] Worker {worker_id} processing {chunk['chunk_id']} ({len(chunk['images'])} images)")
+        stop_heartbeat = start_lock_heartbeat(lock_path, worker_id, max(1, stale_after / 4))
+        details = {}
+        try:
+            results = run_counting_engine(manifest["engine"], chunk["images"], manifest["settings"], config, details=details)
+        finally:
+            stop_heartbeat.set()
+        
+        payload = {
+            "chunk_id": chunk["chunk_id"],
+            "worker_id": worker_id,
+            "finished": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "results": results,
+            "details": details
+        }
+        if not any(results.get(os.path.basename(path)) is not None for path in chunk["images"]):
+            attempts = record_shard_attempt(shard_dir, chunk["chunk_id"], worker_id)
+            if attempts < max_attempts:
+                # Publishing would mark the chunk done with no counts; let another worker retry it
+                print(f"[ERROR] Every image in {chunk['chunk_id']} failed (attempt {attempts} of {max_attempts}); releasing it for another worker")
+                failed_chunks.add(chunk["chunk_id"])
+                release_lock(lock_path, worker_id)
+                continue
+            # Out of attempts: publish the failure so the job can finish and report it
+            print(f"[ERROR] Every image in {chunk['chunk_id']} failed on {attempts} attempts; marking the chunk failed")
+            payload.update(failed=True, attempts=attempts)
+        
+        if publish_shard_result(shard_dir, chunk["chunk_id"], payload):
+            if not payload.get("failed"):
+                completed += 1
+            print(f"[INFO] Published result for {chunk['chunk_id']}")
+        else:
+            print(f"[INFO] Result for {chunk['chunk_id']} already published by another worker; discarded")
+        
+        release_lock(lock_path, worker_id)
+    
+    print(f"[INFO] Shard worker {worker_id} finished. Chunks completed: {completed}")
+    return completed
+
+def get_shard_marker_path(shard_dir, chunk_id):
+    """Return the merge marker of a chunk, which records what was merged from it."""
+    return os.path.join(get_shard_paths(shard_dir)["merged"], f"{chunk_id}.json")
+
+def load_shard_marker(shard_dir, chunk_id):
+    """Load a chunk's merge marker, or None if the chunk has not been merged."""
+    try:
+        with open(get_shard_marker_path(shard_dir, chunk_id), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_shard_results_csv(shard_dir, manifest):
+    """Write every merged entry of the job to its results CSV, rebuilt from the markers."""
+    entries = []
+    for chunk in manifest["chunks"]:
+        marker = load_shard_marker(shard_dir, chunk["chunk_id"])
+        if marker:
+            entries.extend(marker["entries"])
+    fieldnames = []
+    for entry in entries:
+        fieldnames.extend(key for key in entry if key not in fieldnames)
+    
+    csv_path = get_shard_paths(shard_dir)["csv"]
+    temp_path = f"{csv_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, restval="")
+        writer.writeheader()
+        writer.writerows(entries)
+    os.replace(temp_path, csv_path)
+    return csv_path
+
+def merge_shard_results(shard_dir):
+    """Merge published chunk results exactly once. Returns entries merged.
+
+    Each chunk's marker holds the entries merged from it and is written
+    before history, so a crash can never merge a chunk twice. The markers
+    are the complete record, collected in the job's results CSV; history
+    only keeps its usual latest entries.
+    """
+    manifest = load_shard_manifest(shard_dir)
+    if manifest is None:
+        return 0
+    
+    paths = get_shard_paths(shard_dir)
+    stale_after = manifest.get("stale_after", SHARD_STALE_SECONDS)
+    owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    if not try_create_lock(paths["merge_lock"], owner):
+        if not (is_lock_stale(paths["merge_lock"], stale_after) and steal_lock(paths["merge_lock"], owner, stale_after)):
+            print("[INFO] Another process is merging shard results")
+            return 0
+    
+    merged_count = 0
+    try:
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for chunk in manifest["chunks"]:
+            chunk_id = chunk["chunk_id"]
+            marker_path = get_shard_marker_path(shard_dir, chunk_id)
+            result_path = shard_result_path(shard_dir, chunk_id)
+            if os.path.exists(marker_path) or not os.path.exists(result_path):
+                continue
+            
+            with open(result_path, "r") as f:
+                payload = json.load(f)
+            tag = f"{manifest['job_id']}/{chunk_id}"
+            if payload.get("failed"):
+                print(f"[ERROR] Chunk {chunk_id} failed after {payload.get('attempts')} attempts; nothing merged")
+                write_json_atomic(marker_path, {"chunk_id": chunk_id, "failed": True, "entries": []})
+                continue
+            
+            results = payload["results"]
+            details = payload.get("details", {})
+            entries = []
+            for image_path in chunk["images"]:
+                filename = os.path.basename(image_path)
+                if results.get(filename) is not None:
+                    entry = {"filename": filename, "count": results[filename], "timestamp": timestamp, "shard": tag}
+                    qc_path = get_run_qc_path(details.get(filename, {}))
+                    if qc_path:
+                        entry["qc_path"] = qc_path
+                    entry.update(get_result_fields(image_path, details.get(filename, {}), results[filename]))
+                    entries.append(entry)
+                else:
+                    print(f"[ERROR] Processing failed for: {filename}")
+            
+            # The marker is the merge record; history is only updated once it exists
+            write_json_atomic(marker_path, {"chunk_id": chunk_id, "failed": False, "entries": entries})
+            merged_count += len(entries)
+            if entries:
+                save_entries_to_history(entries)
+        
+        if merged_count:
+            print(f"[INFO] Shard results written to {write_shard_results_csv(shard_dir, manifest)}")
+    finally:
+        release_lock(paths["merge_lock"], owner)
+    
+    print(f"[INFO] Merged {merged_count} shard results")
+    return merged_count
+
+def get_failed_shard_chunks(shard_dir, manifest):
+    """Return the IDs of chunks that were given up on after too many failed attempts."""
+    failed = []
+    for chunk in manifest["chunks"]:
+        marker = load_shard_marker(shard_dir, chunk["chunk_id"])
+        if marker and marker.get("failed"):
+            failed.append(chunk["chunk_id"])
+    return failed
+
+def coordinate_shard_job(shard_dir, image_paths, engine="imagej", chunk_size=8, wait=True, poll_seconds=SHARD_POLL_SECONDS,
+                         max_attempts=SHARD_MAX_ATTEMPTS):
+    """Create a shard job and merge worker results into history as they arrive.
+
+    Returns False if the job could not be created or some chunks failed on
+    every attempt.
+    """
+    manifest = create_shard_job(shard_dir, image_paths, engine=engine, chunk_size=chunk_size, max_attempts=max_attempts)
+    if manifest is None or not wait:
+        return manifest is not None
+    
+    total_chunks = len(manifest["chunks"])
+    print(f"[STEP] Waiting for workers to process {total_chunks} chunks in {shard_dir}")
+    while True:
+        merge_shard_results(shard_dir)
+        done = sum(1 for chunk in manifest["chunks"] if os.path.exists(get_shard_marker_path(shard_dir, chunk["chunk_id"])))
+        if done >= total_chunks:
+            break
+        print(f"[INFO] {done}/{total_chunks} chunks merged")
+        time.sleep(poll_seconds)
+    
+    failed = get_failed_shard_chunks(shard_dir, manifest)
+    if failed:
+        print(f"[ERROR] Shard job {manifest['job_id']} finished with {len(failed)} failed chunks: {', '.join(failed)}")
+        return False
+    print(f"[INFO] Shard job {manifest['job_id']} complete; results in {get_shard_paths(shard_dir)['csv']}")
+    return True
+
+def run_shard_cli(argv):
+    """Command-line entry point for --coordinate, --worker and --merge modes."""
+    parser = argparse.ArgumentParser(prog="Imagerier.py", description="Count nuclei across several machines using a shared directory")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--coordinate", metavar="SHARD_DIR", help="write a job manifest and merge results into history")
+    mode.add_argument("--worker", metavar="SHARD_DIR", help="claim and process chunks from a job manifest")
+    mode.add_argument("--merge", metavar="SHARD_DIR", help="merge any finished chunk results into history")
+    parser.add_argument("images", nargs="*", help="images to count (coordinator only)")
+    parser.add_argument("--engine", choices=COUNTING_ENGINES, default="imagej")
+    parser.add_argument("--chunk-size", type=int, default=8)
+    parser.add_argument("--no-wait", action="store_true", help="coordinator exits after writing the manifest")
+    parser.add_argument("--max-attempts", type=int, default=SHARD_MAX_ATTEMPTS, help="failed attempts before a chunk is given up (coordinator only)")
+    parser.add_argument("--worker-id", default=None)
+    parser.add_argument("--poll", type=float, default=SHARD_POLL_SECONDS)
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve Prometheus metrics on this local port")
+    parser.add_argument("--metrics-file", default=None, help="write Prometheus metrics to this textfile-collector file")
+    args = parser.parse_args(argv)
+    start_metrics_exporters(args.metrics_port, args.metrics_file)
+    
+    try:
+        if args.coordinate:
+            if not args.images:
+                parser.error("--coordinate requires at least one image")
+            return coordinate_shard_job(args.coordinate, args.images, engine=args.engine, chunk_size=args.chunk_size, wait=not args.no_wait, poll_seconds=args.poll,
+                                        max_attempts=max(1, args.max_attempts))
+        if args.worker:
+            run_shard_worker(args.worker, worker_id=args.worker_id, poll_seconds=args.poll)
+            return True
+        merge_shard_results(args.merge)
+        return True
+    finally:
+        if args.metrics_file:
+            write_metrics_textfile(args.metrics_file)
+
+STREAM_ID_HEADER = struct.Struct(">H")
+STREAM_LENGTH_HEADER = struct.Struct(">I")
+STREAM_POLL_SECONDS = 0.5
+
+def read_exact(stream, size):
+    """Read exactly size bytes, or fewer only at end of stream."""
+    data = bytearray()
+    while len(data) < size:
+        block = stream.read(size - len(data))
+        if not block:
+            break
+        data += block
+    return bytes(data)
+
+def read_stream_frame(stream, max_bytes):
+    """Read one frame: 2-byte ID length, UTF-8 ID, 4-byte payload length, payload.
+
+    Lengths are big-endian. Returns (frame_id, payload, error) or None at end
+    of stream. Payloads over max_bytes are skipped and reported as an error.
+    """
+    header = read_exact(stream, STREAM_ID_HEADER.size)
+    if not header:
+        return None
+    if len(header) < STREAM_ID_HEADER.size:
+        raise EOFError("truncated frame header")
+    frame_id = read_exact(stream, STREAM_ID_HEADER.unpack(header)[0]).decode("utf-8", errors="replace")
+    header = read_exact(stream, STREAM_LENGTH_HEADER.size)
+    if len(header) < STREAM_LENGTH_HEADER.size:
+        raise EOFError(f"truncated frame {frame_id}")
+    length = STREAM_LENGTH_HEADER.unpack(header)[0]
+    
+    if length > max_bytes:
+        # Skip the payload in blocks so the stream stays in sync
+        remaining = length
+        while remaining:
+            block = stream.read(min(remaining, 1024 * 1024))
+            if not block:
+                raise EOFError(f"truncated frame {frame_id}")
+            remaining -= len(block)
+        return frame_id, None, f"frame of {length} bytes exceeds the {max_bytes} byte limit"
+    
+    payload = read_exact(stream, length)
+    if len(payload) < length:
+        raise EOFError(f"truncated frame {frame_id}")
+    return frame_id, payload, None
+
+def run_stream_counting(input_stream, output, steps, channel=0, workers=1, max_frames=4, max_bytes=256 * 1024 * 1024):
+    """Count nuclei in image frames read from input_stream until it ends.
+
+    One JSON line per frame is written to output as soon as the frame is
+    counted (frames may finish out of order with several workers). At most
+    max_frames encoded payloads wait in the queue: the reader blocks when it
+    is full, so a fast producer stalls on a full pipe instead of growing
+    memory. Counting in progress and the frame being read add one payload
+    each, so up to (max_frames + workers + 1) * max_bytes of encoded frames
+    are held. If output cannot be written (e.g. the consumer closed the
+    pipe) reading and counting stop. Returns the number of frames that
+    failed or whose result could not be written.
+    """
+    frames = queue.Queue(maxsize=max_frames)
+    output_lock = threading.Lock()
+    stopped = threading.Event()
+    failures = []
+    
+    def emit(result):
+        with output_lock:
+            if stopped.is_set():
+                failures.append(result["id"])
+                return
+            try:
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+            except (OSError, ValueError) as e:
+                # ValueError: output was closed
+                print(f"[ERROR] Cannot write results, stopping: {e}")
+                stopped.set()
+                failures.append(result["id"])
+                return
+            if result.get("count") is None:
+                failures.append(result["id"])
+    
+    def put_frame(frame):
+        # Time out regularly so a stop is noticed even when the queue stays full
+        while not stopped.is_set():
+            try:
+                frames.put(frame, timeout=STREAM_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def read_frames():
+        try:
+            while not stopped.is_set():
+                frame = read_stream_frame(input_stream, max_bytes)
+                if frame is None or not put_frame(frame):
+                    break
+                metric_set("nuclei_counter_queue_depth", frames.qsize(), queue="stream")
+        except Exception as e:
+            print(f"[ERROR] Stopped reading frames: {e}")
+            emit({"id": None, "count": None, "error": str(e)})
+        finally:
+            for _ in range(workers):
+                put_frame(None)
+    
+    def count_frames():
+        while not stopped.is_set():
+            try:
+                frame = frames.get(timeout=STREAM_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if frame is None:
+                break
+            metric_set("nuclei_counter_queue_depth", frames.qsize(), queue="stream")
+            frame_id, payload, error = frame
+            if error:
+                record_image_metrics("native", reason="frame_rejected")
+                emit({"id": frame_id, "count": None, "error": error})
+                continue
+            start = time.time()
+            try:
+                plane = decode_image_plane(io.BytesIO(payload), channel)
+            except Exception as e:
+                record_image_metrics("native", reason="decode_failed")
+                emit({"id": frame_id, "count": None, "error": f"decode failed: {e}"})
+                continue
+            del payload
+            report = {}
+            try:
+                count, _ = count_native_plane(plane, steps, report=report)
+            except Exception as e:
+                record_image_metrics("native", reason="processing_error")
+                emit({"id": frame_id, "count": None, "error": str(e)})
+                continue
+            seconds = time.time() - start
+            record_image_metrics("native", seconds)
+            emit({"id": frame_id, "count": count, "width": plane.shape[1], "height": plane.shape[0], "millis": round(seconds * 1000, 1),
+                  "watershed": report["watershed"]})
+    
+    reader = threading.Thread(target=read_frames, daemon=True)
+    reader.start()
+    counters = [threading.Thread(target=count_frames, daemon=True) for _ in range(workers)]
+    for counter in counters:
+        counter.start()
+    for counter in counters:
+        counter.join()
+    if not stopped.is_set():
+        # After a stop the reader may be blocked reading input; it is a daemon thread
+        reader.join()
+    metric_set("nuclei_counter_queue_depth", 0, queue="stream")
+    return len(failures)
+
+def run_stream_cli(argv, output):
+    """Command-line entry point for --stream mode; results are written to output."""
+    parser = argparse.ArgumentParser(prog="Imagerier.py --stream", description="Count nuclei in length-prefixed image frames read from stdin or a pipe")
+    parser.add_argument("--input", default=None, help="read frames from this file or named pipe instead of stdin")
+    parser.add_argument("--channel", type=int, default=None, help="nuclear-stain channel (default: saved setting)")
+    parser.add_argument("--workers", type=int, default=1, help="frames counted at the same time")
+    parser.add_argument("--max-frames", type=int, default=4,
+                        help="encoded frames buffered before reading pauses; up to (max-frames + workers + 1) x max-frame-mb "
+                             "is held in memory (1.5 GB with the defaults)")
+    parser.add_argument("--max-frame-mb", type=float, default=256, help="reject frames larger than this")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve Prometheus metrics on this local port")
+    parser.add_argument("--metrics-file", default=None, help="write Prometheus metrics to this textfile-collector file")
+    args = parser.parse_args(argv)
+    
+    if not native_engine_available():
+        print("[ERROR] Stream mode requires numpy, scipy and Pillow")
+        return False
+    config = {}
+    if os.path.exists(CONFIG_FILE):
+        try:
+            with open(CONFIG_FILE, "r") as f:
+                config = json.load(f)
+        except Exception:
+            pass
+    settings = get_processing_settings()
+    channel = settings.get("channel", 0) if args.channel is None else args.channel
+    steps = get_native_steps(config.get("macro_path"), settings)
+    if steps is None:
+        print("[ERROR] Stream mode runs in-process only; disable the custom macro or remove its unsupported commands")
+        return False
+    
+    start_metrics_exporters(args.metrics_port, args.metrics_file)
+    print(f"[STEP] Waiting for frames on {args.input or 'stdin'}")
+    try:
+        with (open(args.input, "rb") if args.input else sys.stdin.buffer) as input_stream:
+            failures = run_stream_counting(input_stream, output, steps, channel, max(1, args.workers), max(1, args.max_frames),
+                                           int(args.max_frame_mb * 1024 * 1024))
+    finally:
+        if args.metrics_file:
+            write_metrics_textfile(args.metrics_file)
+    print(f"[INFO] Stream ended ({failures} failed frames)")
+    return failures == 0
+
 def create_gui():
     """Create the main GUI with simplified controls and protocol help."""
     try:
@@ -673,12 +3246,27 @@ def create_gui():
         keep_images_var = tk.BooleanVar()
         keep_images_var.set(False)  # Default to closing images
         
-        use_watershed_var = tk.BooleanVar()
-        use_watershed_var.set(True)  # Default to using watershed
+        watershed_choices = ["Always", "Auto (only where nuclei touch)", "Never"]
+        watershed_values = [True, WATERSHED_AUTO, False]
+        watershed_var = tk.StringVar()
+        watershed_var.set(watershed_choices[0])  # Default to using watershed
         
         disable_macro_var = tk.BooleanVar()
         disable_macro_var.set(False)  # Default to using macro if available
         
+        pixel_cache_var = tk.BooleanVar()
+        pixel_cache_var.set(False)  # Default to decoding every time
+        
+        incremental_var = tk.BooleanVar()
+        incremental_var.set(False)  # Default to counting whole images
+        
+        native_engine_var = tk.BooleanVar()
+        native_engine_var.set(False)  # Default to ImageJ only
+        
+        channel_choices = ["All channels (blend)", "1 (Red)", "2 (Green)", "3 (Blue)", "4"]
+        channel_var = tk.StringVar()
+        channel_var.set(channel_choices[0])  # Default to blending all channels
+        
         # Options frame
         options_frame = ttk.LabelFrame(main_frame, text="Processing Options", padding="10")
         options_frame.pack(fill=tk.X, pady=(0, 10))
@@ -693,13 +3281,12 @@ def create_gui():
         create_tooltip(keep_images_check, "When enabled, ImageJ will remain open with all processed images for manual inspection and verification.")
         
         # Watershed option
-        watershed_check = ttk.Checkbutton(
-            options_frame, 
-            text="Enable watershed segmentation (separates touching nuclei)", 
-            variable=use_watershed_var
-        )
-        watershed_check.pack(anchor='w', pady=2)
-        create_tooltip(watershed_check, "Watershed helps separate touching or overlapping nuclei. Disable for faster processing if nuclei are well-separated.")
+        watershed_frame = ttk.Frame(options_frame)
+        watershed_frame.pack(anchor='w', pady=2)
+        ttk.Label(watershed_frame, text="Watershed segmentation (separates touching nuclei):").pack(side=tk.LEFT, padx=(0, 5))
+        watershed_combo = ttk.Combobox(watershed_frame, textvariable=watershed_var, values=watershed_choices, state="readonly", width=28)
+        watershed_combo.pack(side=tk.LEFT)
+        create_tooltip(watershed_combo, "Watershed helps separate touching or overlapping nuclei. Auto checks particle size and shape first and only splits where nuclei appear to touch; the decision is saved with each count.")
         
         # Disable macro option
         disable_macro_check = ttk.Checkbutton(
@@ -710,6 +3297,48 @@ def create_gui():
         disable_macro_check.pack(anchor='w', pady=2)
         create_tooltip(disable_macro_check, "When enabled, always uses built-in processing even if a custom macro is selected.")
         
+        # Nuclear stain channel option
+        channel_frame = ttk.Frame(options_frame)
+        channel_frame.pack(anchor='w', pady=2)
+        ttk.Label(channel_frame, text="Nuclear stain channel:").pack(side=tk.LEFT, padx=(0, 5))
+        channel_combo = ttk.Combobox(channel_frame, textvariable=channel_var, values=channel_choices, state="readonly", width=22)
+        channel_combo.pack(side=tk.LEFT)
+        create_tooltip(channel_combo, "Process only the nuclear-stain channel (e.g. Blue for DAPI) instead of blending all channels into 8-bit.")
+        
+        # Decoded pixel cache option
+        pixel_cache_check = ttk.Checkbutton(
+            options_frame, 
+            text="Cache decoded pixels (in-process engine only)", 
+            variable=pixel_cache_var
+        )
+        pixel_cache_check.pack(anchor='w', pady=2)
+        
+        # Incremental tiled counting option
+        incremental_check = ttk.Checkbutton(
+            options_frame, 
+            text="Incremental re-counting (only changed tiles of large images)", 
+            variable=incremental_var,
+            command=lambda: update_pixel_cache_state()
+        )
+        incremental_check.pack(anchor='w', pady=2)
+        
+        # In-process engine option
+        native_engine_check = ttk.Checkbutton(
+            options_frame, 
+            text="Allow in-process engine when faster (experimental)", 
+            variable=native_engine_var,
+            command=lambda: update_pixel_cache_state()
+        )
+        native_engine_check.pack(anchor='w', pady=2)
+        create_tooltip(native_engine_check, "Lets the planner count with the built-in Python reimplementation (needs numpy, scipy and Pillow) instead of ImageJ. Its counts are not yet validated against ImageJ; the engine used is saved with each count.")
+        create_tooltip(incremental_check, "For growing stitched or live images: remembers per-tile results and re-processes only tiles whose pixels changed, plus their neighbours. Uses built-in (in-process) processing; no QC overlay is saved.")
+        create_tooltip(pixel_cache_check, f"Keeps decoded 8-bit images in {PIXEL_CACHE_DIR} so re-counting with other settings skips decoding. ImageJ does not use it, so it is only available with the in-process engine or incremental re-counting.")
+        
+        def update_pixel_cache_state():
+            # The cache only feeds the in-process engine; ImageJ decodes images itself
+            enabled = native_engine_var.get() or incremental_var.get()
+            pixel_cache_check.state(["!disabled"] if enabled else ["disabled"])
+        
         button_frame = ttk.LabelFrame(main_frame, text="Actions", padding="10")
         button_frame.pack(fill=tk.X, pady=(0, 15))
         
@@ -773,16 +3402,24 @@ def create_gui():
         def count_and_refresh():
             try:
                 keep_open = keep_images_var.get()
-                use_watershed = use_watershed_var.get()
+                use_watershed = watershed_values[watershed_choices.index(watershed_var.get())]
                 disable_macro = disable_macro_var.get()
+                channel = channel_choices.index(channel_var.get())
+                pixel_cache = pixel_cache_var.get()
+                incremental = incremental_var.get()
+                native_engine = native_engine_var.get()
                 
                 settings = {
                     "use_watershed": use_watershed,
-                    "disable_macro": disable_macro
+                    "disable_macro": disable_macro,
+                    "channel": channel,
+                    "pixel_cache": pixel_cache,
+                    "incremental": incremental,
+                    "native_engine": native_engine
                 }
                 save_processing_settings(settings)
                 
-                select_and_count(keep_images_open=keep_open, use_watershed=use_watershed, disable_macro=disable_macro)
+                select_and_count(keep_images_open=keep_open, use_watershed=use_watershed, disable_macro=disable_macro, channel=channel, pixel_cache=pixel_cache, incremental=incremental, native_engine=native_engine)
                 refresh_history()
                 
                 status_text = "Processing complete! "
@@ -864,14 +3501,20 @@ def create_gui():
         history_tree.configure(yscrollcommand=scrollbar.set)
         history_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         
-        create_tooltip(history_tree, "Double-click an entry to view details, or select and use buttons above to delete")
+        create_tooltip(history_tree, "Double-click an entry to view its QC overlay, or select and use buttons above to delete")
         
         status_label = ttk.Label(main_frame, text="Ready", relief=tk.SUNKEN, anchor=tk.W)
         status_label.pack(fill=tk.X, pady=(10, 0))
         
         settings = get_processing_settings()
-        use_watershed_var.set(settings.get("use_watershed", True))
+        saved_watershed = settings.get("use_watershed", True)
+        watershed_var.set(watershed_choices[watershed_values.index(saved_watershed)] if saved_watershed in watershed_values else watershed_choices[0])
         disable_macro_var.set(settings.get("disable_macro", False))
+        channel_var.set(channel_choices[min(settings.get("channel", 0), len(channel_choices) - 1)])
+        pixel_cache_var.set(settings.get("pixel_cache", False))
+        incremental_var.set(settings.get("incremental", False))
+        native_engine_var.set(settings.get("native_engine", False))
+        update_pixel_cache_state()
         
         refresh_history()
         
@@ -880,8 +3523,22 @@ def create_gui():
             if selection:
                 item = selection[0]
                 values = history_tree.item(item, 'values')
-                messagebox.showinfo("Entry Details", 
-                                   f"File: {values[0]}\nCount: {values[1]}\nTimestamp: {values[2]}")
+                entry = next((e for e in get_history() if e.get("filename") == values[0] and e.get("timestamp") == values[2]), {})
+                qc_path = entry.get("qc_path")
+                if qc_path and os.path.exists(qc_path):
+                    show_qc_overlay(root, entry)
+                else:
+                    roi_text = ""
+                    if "engine" in entry:
+                        roi_text += f"\nEngine: {entry['engine']}"
+                    if "roi_area_px" in entry:
+                        roi_text += f"\nROI area: {entry['roi_area_px']} px"
+                        if "density_per_mm2" in entry:
+                            roi_text += f"\nDensity: {entry['density_per_mm2']} nuclei/mm²"
+                    if "watershed" in entry:
+                        roi_text += f"\nWatershed: {entry['watershed']}"
+                    messagebox.showinfo("Entry Details", 
+                                       f"File: {values[0]}\nCount: {values[1]}\nTimestamp: {values[2]}{roi_text}\n\nNo QC overlay saved for this entry.")
         
         history_tree.bind('<Double-1>', on_double_click)
         
@@ -893,9 +3550,27 @@ def create_gui():
         raise
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["--stream"]:
+        # stdout carries only result lines; log messages go to stderr
+        result_output = sys.stdout
+        sys.stdout = sys.stderr
     print("[INFO] Nuclei Counter v3.11 started.")
     
-    if len(sys.argv) == 2:
+    if sys.argv[1:2] == ["--stream"]:
+        try:
+            if not run_stream_cli(sys.argv[2:], result_output):
+                sys.exit(1)
+        except Exception as e:
+            print(f"[ERROR] Stream mode failed: {e}")
+            sys.exit(1)
+    elif len(sys.argv) > 1 and sys.argv[1] in ("--coordinate", "--worker", "--merge"):
+        try:
+            if not run_shard_cli(sys.argv[1:]):
+                sys.exit(1)
+        except Exception as e:
+            print(f"[ERROR] Shard mode failed: {e}")
+            sys.exit(1)
+    elif len(sys.argv) == 2:
         try:
             config = get_config()
             image_path = sys.argv[1]
@@ -906,12 +3581,15 @@ if __name__ == "__main__":
             
             print(f"[STEP] Running in command-line mode for image: {os.path.basename(image_path)}")
             
-            batch_results = count_multiple_nuclei_with_imagej([image_path], config["macro_path"], config["imagej_path"], keep_images_open=False, use_watershed=True, disable_macro=False)
+            channel = get_processing_settings().get("channel", 0)
+            details = {}
+            batch_results = count_multiple_nuclei_with_imagej([image_path], config["macro_path"], config["imagej_path"], keep_images_open=False, use_watershed=True, disable_macro=False, channel=channel, details=details)
             filename = os.path.basename(image_path)
             count = batch_results.get(filename)
             
             if count is not None:
-                save_to_history(filename, count)
+                fields = get_result_fields(image_path, details.get(filename, {}), count)
+                save_to_history(filename, count, get_run_qc_path(details.get(filename, {})), fields)
                 print(f"[SUCCESS] Nuclei count: {count}")
             else:
                 print("[ERROR] Failed to count nuclei.")
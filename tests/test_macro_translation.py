@@ -0,0 +1,90 @@
+import os
+import sys
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import Imagerier
+
+
+class SplitMacroStatementsTests(unittest.TestCase):
+    def test_semicolons_newlines_and_comments(self):
+        macro = 'run("8-bit"); run("Invert")\n// run("Watershed");\n/* setThreshold(0, 1);\n*/ count = nResults;\n'
+        self.assertEqual(Imagerier.split_macro_statements(macro), [
+            (1, 'run("8-bit")'), (1, 'run("Invert")'), (4, 'count = nResults')])
+
+    def test_newline_inside_parentheses_continues_the_statement(self):
+        macro = 'run("Median...",\n    "radius=3");\nrun("Invert");\n'
+        self.assertEqual(Imagerier.split_macro_statements(macro), [
+            (1, 'run("Median...",     "radius=3")'), (3, 'run("Invert")')])
+
+    def test_separators_inside_strings_are_kept(self):
+        macro = 'print("a; b // c (");\nrun("Invert");'
+        self.assertEqual(Imagerier.split_macro_statements(macro), [
+            (1, 'print("a; b // c (")'), (2, 'run("Invert")')])
+
+
+class TranslateMacroTests(unittest.TestCase):
+    def translate(self, body):
+        return Imagerier.translate_macro(body + '\nrun("Analyze Particles...", "size=450-Infinity");')
+
+    def test_counter_macro_is_fully_supported(self):
+        with open(os.path.join(REPO, "Counter.ijm")) as f:
+            steps, unsupported = Imagerier.translate_macro(f.read())
+        self.assertEqual(unsupported, [])
+        self.assertEqual(steps, [
+            ("8-bit", {}),
+            ("Median...", {"radius": 3.0}),
+            ("setAutoThreshold", {"method": "Otsu", "dark": False}),
+            ("Convert to Mask", {}),
+            ("Invert", {}),
+            ("Watershed", {}),
+            ("Analyze Particles...", {"size": (450.0, 25000.0), "circularity": (0.3, 1.0), "exclude": False, "include": False})
+        ])
+
+    def test_string_expression_is_not_a_literal(self):
+        statement = 'run("Analyze Particles...", "size=450" + "-25000")'
+        steps, unsupported = Imagerier.translate_macro(statement + ";")
+        self.assertIn((1, statement), unsupported)
+        self.assertEqual(steps, [])
+
+    def test_arguments_with_commas_inside_strings(self):
+        self.assertEqual(Imagerier.parse_macro_arguments('"a, b", 3, true'), ["a, b", 3.0, True])
+        self.assertIsNone(Imagerier.parse_macro_arguments('"a" "b"'))
+        self.assertIsNone(Imagerier.parse_macro_arguments('"radius=" + r'))
+
+    def test_convert_to_mask_options_are_translated(self):
+        steps, unsupported = self.translate('run("Convert to Mask", "method=Otsu background=Dark calculate");')
+        self.assertEqual(unsupported, [])
+        self.assertEqual(steps[0], ("Convert to Mask", {"method": "Otsu", "dark": True}))
+
+        steps, unsupported = self.translate('run("Make Binary");')
+        self.assertEqual(steps[0], ("Convert to Mask", {}))
+
+    def test_unsupported_convert_to_mask_options_are_reported(self):
+        for options in ("method=Huang background=Dark", "method=Otsu background=Default", "method=Otsu background=Dark black"):
+            statement = f'run("Convert to Mask", "{options}")'
+            steps, unsupported = self.translate(statement + ";")
+            self.assertIn((1, statement), unsupported)
+
+    def test_macro_without_analyze_particles_is_unsupported(self):
+        steps, unsupported = Imagerier.translate_macro('run("8-bit");')
+        self.assertEqual(unsupported, [(0, 'no run("Analyze Particles...") to count with')])
+
+
+@unittest.skipUnless(Imagerier.native_engine_available(), "needs numpy, scipy and Pillow")
+class ConvertToMaskPipelineTests(unittest.TestCase):
+    def test_mask_options_pick_the_threshold(self):
+        import numpy as np
+        plane = np.full((60, 60), 40, dtype=np.uint8)
+        plane[10:30, 10:30] = 200
+        plane[35:55, 35:55] = 200
+        analyze = ("Analyze Particles...", {"size": (0, float("inf")), "circularity": (0.0, 1.0), "exclude": False, "include": False})
+        dark, _ = Imagerier.run_native_pipeline(plane, [("Convert to Mask", {"method": "Otsu", "dark": True}), analyze])
+        light, _ = Imagerier.run_native_pipeline(plane, [("Convert to Mask", {"method": "Otsu", "dark": False}), analyze])
+        self.assertEqual(dark, 2)
+        self.assertEqual(light, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
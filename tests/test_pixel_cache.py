@@ -0,0 +1,40 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Imagerier
+
+
+@unittest.skipUnless(Imagerier.native_engine_available(), "needs numpy, scipy and Pillow")
+class PixelCacheTests(unittest.TestCase):
+    def setUp(self):
+        import numpy as np
+        from PIL import Image
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = {"dir": os.path.join(self.tmp.name, "cache"), "max_bytes": 10 ** 8}
+        self.pixels = (np.random.rand(50, 50) * 255).astype(np.uint8)
+        self.save = lambda path, pixels: Image.fromarray(pixels).save(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def decode(self, path):
+        return Imagerier.decode_image_plane_cached(path, 0, self.cache)
+
+    def test_changed_source_keeps_planes_shared_with_other_paths(self):
+        first, second = (os.path.join(self.tmp.name, name) for name in ("c.png", "d.png"))
+        self.save(first, self.pixels)
+        self.save(second, self.pixels)
+        self.assertEqual([self.decode(first)[1], self.decode(second)[1]], ["miss", "hit"])
+
+        self.save(second, 255 - self.pixels)
+        plane, result = self.decode(second)
+        self.assertEqual(result, "miss")
+        self.assertEqual(int(plane[0, 0]), 255 - int(self.pixels[0, 0]))
+        self.assertEqual(self.decode(first)[1], "hit")
+
+
+if __name__ == "__main__":
+    unittest.main()
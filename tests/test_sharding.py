@@ -0,0 +1,160 @@
+import csv
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import zlib
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Imagerier
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Imagerier.py")
+
+
+def make_stale_lock(lock_path, owner):
+    with open(lock_path, "w") as f:
+        f.write(owner)
+    old = time.time() - 3600
+    os.utime(lock_path, (old, old))
+
+
+class StealLockTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.lock_path = os.path.join(self.tmp.name, "chunk.lock")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_second_stealer_gives_up(self):
+        make_stale_lock(self.lock_path, "dead")
+        self.assertTrue(Imagerier.steal_lock(self.lock_path, "A", 60))
+        self.assertEqual(Imagerier.read_lock_owner(self.lock_path), "A")
+
+        # B saw the old stale lock before A replaced it
+        real_read = Imagerier.read_lock_owner
+        calls = []
+
+        def stale_view(path):
+            calls.append(path)
+            return "dead" if len(calls) == 1 else real_read(path)
+
+        with mock.patch.object(Imagerier, "read_lock_owner", side_effect=stale_view):
+            self.assertFalse(Imagerier.steal_lock(self.lock_path, "B", 60))
+        self.assertEqual(Imagerier.read_lock_owner(self.lock_path), "A")
+        self.assertEqual(os.listdir(self.tmp.name), ["chunk.lock"])
+
+    def test_release_only_by_owner(self):
+        Imagerier.try_create_lock(self.lock_path, "A")
+        self.assertFalse(Imagerier.release_lock(self.lock_path, "B"))
+        self.assertTrue(os.path.exists(self.lock_path))
+        self.assertTrue(Imagerier.release_lock(self.lock_path, "A"))
+        self.assertFalse(os.path.exists(self.lock_path))
+
+
+class ShardProcessTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = dict(os.environ, HOME=self.tmp.name)
+        self.shard_dir = os.path.join(self.tmp.name, "shard")
+        self.images = []
+        for index in range(12):
+            path = os.path.join(self.tmp.name, f"image_{index:02d}.png")
+            with open(path, "wb") as f:
+                f.write(os.urandom(64))
+            self.images.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_cli(self, *args):
+        return subprocess.Popen([sys.executable, SCRIPT, *args], env=self.env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def start_coordinator(self, *args):
+        coordinator = self.run_cli("--coordinate", self.shard_dir, *args, "--poll", "0.2")
+        manifest_path = Imagerier.get_shard_paths(self.shard_dir)["manifest"]
+        deadline = time.time() + 30
+        while not os.path.exists(manifest_path) and time.time() < deadline:
+            time.sleep(0.05)
+        return coordinator
+
+    def read_history(self):
+        with open(os.path.join(self.tmp.name, ".nuclei_counter_history.json")) as f:
+            return json.load(f)
+
+    def test_workers_and_racing_mergers_record_each_image_once(self):
+        coordinator = self.run_cli("--coordinate", self.shard_dir, *self.images, "--engine", "stub", "--chunk-size", "2", "--no-wait")
+        self.assertEqual(coordinator.wait(timeout=60), 0)
+
+        workers = [self.run_cli("--worker", self.shard_dir, "--worker-id", f"w{index}", "--poll", "0.2") for index in range(3)]
+        for worker in workers:
+            self.assertEqual(worker.wait(timeout=120), 0)
+
+        # Every merger sees a stale merge lock and races to take it over
+        make_stale_lock(Imagerier.get_shard_paths(self.shard_dir)["merge_lock"], "dead")
+        mergers = [self.run_cli("--merge", self.shard_dir) for _ in range(4)]
+        for merger in mergers:
+            merger.wait(timeout=60)
+        self.assertEqual(self.run_cli("--merge", self.shard_dir).wait(timeout=60), 0)
+
+        history = self.read_history()
+        self.assertEqual(sorted(entry["filename"] for entry in history), sorted(os.path.basename(path) for path in self.images))
+        for path in self.images:
+            with open(path, "rb") as f:
+                expected = zlib.crc32(f.read()) % 1000
+            entry = next(entry for entry in history if entry["filename"] == os.path.basename(path))
+            self.assertEqual(entry["count"], expected)
+            self.assertEqual(entry["engine"], "stub")
+
+    def test_merge_keeps_every_result_of_a_large_job(self):
+        for index in range(len(self.images), 130):
+            path = os.path.join(self.tmp.name, f"image_{index:03d}.png")
+            with open(path, "wb") as f:
+                f.write(os.urandom(64))
+            self.images.append(path)
+        coordinator = self.start_coordinator(*self.images, "--engine", "stub", "--chunk-size", "10")
+        self.assertEqual(self.run_cli("--worker", self.shard_dir, "--worker-id", "w0", "--poll", "0.2").wait(timeout=60), 0)
+        self.assertEqual(coordinator.wait(timeout=60), 0)
+        self.assertEqual(self.run_cli("--merge", self.shard_dir).wait(timeout=60), 0)
+
+        with open(Imagerier.get_shard_paths(self.shard_dir)["csv"], newline="") as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(sorted(row["filename"] for row in rows), sorted(os.path.basename(path) for path in self.images))
+        self.assertEqual(len(self.read_history()), 100)
+
+    def test_failed_chunk_is_retried_before_being_published_as_failed(self):
+        missing = [os.path.join(self.tmp.name, f"missing_{index}.png") for index in range(2)]
+        coordinator = self.run_cli("--coordinate", self.shard_dir, *self.images[:2], *missing, "--engine", "stub", "--chunk-size", "2", "--no-wait")
+        self.assertEqual(coordinator.wait(timeout=60), 0)
+        self.assertEqual(self.run_cli("--worker", self.shard_dir, "--worker-id", "w0", "--poll", "0.2").wait(timeout=60), 0)
+
+        paths = Imagerier.get_shard_paths(self.shard_dir)
+        self.assertEqual(sorted(os.listdir(paths["results"])), ["chunk_00000.json", "chunk_00001.json"])
+        with open(Imagerier.shard_result_path(self.shard_dir, "chunk_00000")) as f:
+            self.assertNotIn("failed", json.load(f))
+        with open(Imagerier.shard_result_path(self.shard_dir, "chunk_00001")) as f:
+            payload = json.load(f)
+        self.assertTrue(payload["failed"])
+        self.assertEqual(payload["attempts"], Imagerier.SHARD_MAX_ATTEMPTS)
+        self.assertFalse([name for name in os.listdir(paths["locks"]) if name.endswith(".lock")])
+
+    def test_coordinator_reports_chunks_that_fail_on_every_attempt(self):
+        missing = os.path.join(self.tmp.name, "missing.png")
+        coordinator = self.start_coordinator(self.images[0], missing, "--engine", "stub", "--chunk-size", "1")
+        worker = self.run_cli("--worker", self.shard_dir, "--worker-id", "w0", "--poll", "0.2")
+        self.assertEqual(worker.wait(timeout=60), 0)
+        self.assertEqual(coordinator.wait(timeout=60), 1)
+
+        paths = Imagerier.get_shard_paths(self.shard_dir)
+        self.assertEqual(Imagerier.get_failed_shard_chunks(self.shard_dir, Imagerier.load_shard_manifest(self.shard_dir)), ["chunk_00001"])
+        attempts = [name for name in os.listdir(paths["locks"]) if name.startswith("chunk_00001.attempt-")]
+        self.assertEqual(len(attempts), Imagerier.SHARD_MAX_ATTEMPTS)
+        self.assertEqual([entry["filename"] for entry in self.read_history()], [os.path.basename(self.images[0])])
+
+if __name__ == "__main__":
+    unittest.main()
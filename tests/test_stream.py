@@ -0,0 +1,128 @@
+import io
+import json
+import os
+import struct
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Imagerier
+
+
+def frame(frame_id, payload):
+    encoded_id = frame_id.encode("utf-8")
+    return struct.pack(">H", len(encoded_id)) + encoded_id + struct.pack(">I", len(payload)) + payload
+
+
+class ReadStreamFrameTests(unittest.TestCase):
+    def test_frames_are_read_in_order_until_the_end(self):
+        stream = io.BytesIO(frame("a", b"123") + frame("é", b""))
+        self.assertEqual(Imagerier.read_stream_frame(stream, 100), ("a", b"123", None))
+        self.assertEqual(Imagerier.read_stream_frame(stream, 100), ("é", b"", None))
+        self.assertIsNone(Imagerier.read_stream_frame(stream, 100))
+
+    def test_oversized_frame_is_skipped_and_the_stream_stays_in_sync(self):
+        stream = io.BytesIO(frame("big", b"x" * 50) + frame("small", b"ok"))
+        frame_id, payload, error = Imagerier.read_stream_frame(stream, 10)
+        self.assertEqual((frame_id, payload), ("big", None))
+        self.assertIn("exceeds", error)
+        self.assertEqual(Imagerier.read_stream_frame(stream, 10), ("small", b"ok", None))
+
+    def test_truncated_frames_raise(self):
+        whole = frame("a", b"payload")
+        for cut in (1, 4, len(whole) - 1):
+            with self.subTest(cut=cut):
+                with self.assertRaises(EOFError):
+                    Imagerier.read_stream_frame(io.BytesIO(whole[:cut]), 100)
+
+
+class BrokenOutput:
+    """Accepts a few lines, then fails like a pipe whose reader has gone."""
+
+    def __init__(self, lines_before_error):
+        self.lines = []
+        self.lines_before_error = lines_before_error
+
+    def write(self, text):
+        if len(self.lines) >= self.lines_before_error:
+            raise BrokenPipeError(32, "Broken pipe")
+        self.lines.append(text)
+
+    def flush(self):
+        pass
+
+
+class EndlessFrames(io.RawIOBase):
+    """Produces the same frame forever and counts how many were read."""
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.produced = 0
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if not self.pending:
+            self.pending = frame(f"f{self.produced}", self.payload)
+            self.produced += 1
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+@unittest.skipUnless(Imagerier.native_engine_available(), "needs numpy, scipy and Pillow")
+class RunStreamCountingTests(unittest.TestCase):
+    def setUp(self):
+        import numpy as np
+        from PIL import Image
+        pixels = np.full((60, 60), 30, dtype=np.uint8)
+        pixels[10:40, 10:40] = 220
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, "PNG")
+        self.png = buffer.getvalue()
+        self.steps = Imagerier.get_native_steps(None, {"disable_macro": True})
+
+    def run_stream(self, input_stream, output, **options):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            Imagerier.run_stream_counting(input_stream, output, self.steps, **options)), daemon=True)
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive(), "stream counting did not stop")
+        return results[0]
+
+    def test_each_frame_gets_one_result_line(self):
+        data = frame("good", self.png) + frame("junk", b"not an image") + frame("big", b"x" * 5000)
+        output = io.StringIO()
+        failures = self.run_stream(io.BytesIO(data), output, workers=2, max_bytes=4000)
+        lines = {line["id"]: line for line in map(json.loads, output.getvalue().splitlines())}
+        self.assertEqual(set(lines), {"good", "junk", "big"})
+        self.assertEqual(lines["good"]["count"], 1)
+        self.assertIn("decode failed", lines["junk"]["error"])
+        self.assertIn("exceeds", lines["big"]["error"])
+        self.assertEqual(failures, 2)
+
+    def test_truncated_stream_is_reported(self):
+        output = io.StringIO()
+        failures = self.run_stream(io.BytesIO(frame("good", self.png) + frame("cut", self.png)[:-5]), output)
+        lines = {line["id"]: line for line in map(json.loads, output.getvalue().splitlines())}
+        self.assertEqual(set(lines), {"good", None})
+        self.assertEqual(lines["good"]["count"], 1)
+        self.assertIn("truncated", lines[None]["error"])
+        self.assertEqual(failures, 1)
+
+    def test_closed_consumer_stops_reading_and_counting(self):
+        source = EndlessFrames(self.png)
+        output = BrokenOutput(lines_before_error=3)
+        failures = self.run_stream(source, output, workers=2, max_frames=2)
+        self.assertEqual(len(output.lines), 3)
+        self.assertGreaterEqual(failures, 1)
+        # Backpressure: beyond the written results only the frames being counted,
+        # the full queue and the one being read were ever taken from the source
+        self.assertLessEqual(source.produced, len(output.lines) + 2 + 2 + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()